@@ -5,7 +5,11 @@ Built with Google Agent Development Kit (ADK)
 Этот файл определяет главного агента и суб-агентов для отслеживания питания.
 """
 import os
+import asyncio
 import logging
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 from google.adk.agents import Agent
 from google.adk.models.google_llm import Gemini
@@ -15,7 +19,7 @@ from google.genai import types
 # OBSERVABILITY: Логирование и трейсинг
 # ============================================================
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger("nutrition_tracker")
@@ -48,7 +52,9 @@ retry_config = types.HttpRetryOptions(
 # )
 from .tools.sqlite_tools import (
     save_meal,
+    save_meals_bulk,
     get_today_meals,
+    get_today_with_goals,
     get_meals_by_date,
     get_week_meals,
     get_user_goals,
@@ -57,9 +63,11 @@ from .tools.sqlite_tools import (
     delete_meal,
     # Функции для работы с весом
     save_weight,
+    save_weights_bulk,
     get_weight_history,
     get_weight_nutrition_analysis,
     delete_weight,
+    READER_POOL_SIZE,
 )
 from .tools.nutrition_tools import (
     analyze_food_description,
@@ -71,7 +79,57 @@ from .tools.memory_tools import (
     recall_memories,
     forget_memory,
 )
-from .tools.search_tools import search_nutrition_info
+from .tools.search_tools import search_nutrition_info, search_nutrition_info_batch
+
+
+# Отдельный пул для SQLite: медленный поиск в сети не занимает потоки, нужные базе.
+# Потоков столько, сколько подключений (читатели + писатель) — лишним нечего делать
+_db_executor = ThreadPoolExecutor(
+    max_workers=READER_POOL_SIZE + 1, thread_name_prefix="sqlite"
+)
+
+
+def _run_in_thread(func, executor=None):
+    """
+    Делает синхронный tool асинхронным: ADK вызывает sync-функции прямо
+    в event loop, и запрос к SQLite или поиск одного чата тормозит все остальные.
+    functools.wraps сохраняет имя, докстринг и сигнатуру — по ним ADK строит
+    описание инструмента для модели.
+
+    executor=None — общий пул asyncio (как asyncio.to_thread).
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        # Контекст (трейсинг OpenTelemetry) переносим в поток, как это делает to_thread
+        call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(executor, call)
+    return wrapper
+
+
+_run_in_db_thread = functools.partial(_run_in_thread, executor=_db_executor)
+
+
+# Инструменты, которые ходят в базу, — в пуле SQLite, в сеть — в общем пуле
+save_meal = _run_in_db_thread(save_meal)
+save_meals_bulk = _run_in_db_thread(save_meals_bulk)
+get_today_meals = _run_in_db_thread(get_today_meals)
+get_today_with_goals = _run_in_db_thread(get_today_with_goals)
+get_meals_by_date = _run_in_db_thread(get_meals_by_date)
+get_week_meals = _run_in_db_thread(get_week_meals)
+get_user_goals = _run_in_db_thread(get_user_goals)
+update_user_goals = _run_in_db_thread(update_user_goals)
+edit_meal = _run_in_db_thread(edit_meal)
+delete_meal = _run_in_db_thread(delete_meal)
+save_weight = _run_in_db_thread(save_weight)
+save_weights_bulk = _run_in_db_thread(save_weights_bulk)
+get_weight_history = _run_in_db_thread(get_weight_history)
+get_weight_nutrition_analysis = _run_in_db_thread(get_weight_nutrition_analysis)
+delete_weight = _run_in_db_thread(delete_weight)
+store_memory = _run_in_db_thread(store_memory)
+recall_memories = _run_in_db_thread(recall_memories)
+forget_memory = _run_in_db_thread(forget_memory)
+search_nutrition_info_batch = _run_in_thread(search_nutrition_info_batch)
+# search_nutrition_info уже async: ждёт фоновый loop поиска без потока из пула
 
 
 # ============================================================
@@ -144,18 +202,23 @@ data_manager = Agent(
 3. Управлять целями пользователя
 4. Сохранять и анализировать данные о весе
 
+user_id текущего пользователя: {user_id?} (если пусто — используй "default_user")
+
 Когда сохраняешь еду:
 - Используй save_meal с правильными параметрами
 - Всегда указывай user_id, description, calories, protein, fat, carbs
+- Несколько приемов пищи сразу — один вызов save_meals_bulk со списком
 
 Когда работаешь с весом:
 - save_weight(user_id, weight, note) — записать вес (один раз в день)
+- save_weights_bulk(user_id, entries) — записать вес за несколько прошлых дат одним вызовом
 - get_weight_history(user_id, days) — история веса
 - get_weight_nutrition_analysis(user_id, days) — анализ веса в связке с питанием
 - delete_weight(user_id, date) — удалить запись о весе
 
 Когда получаешь историю:
 - Используй get_today_meals для сегодня
+- Используй get_today_with_goals, когда нужен прогресс за сегодня к целям
 - Используй get_meals_by_date для конкретной даты
 - Используй get_week_meals для недельной статистики
 
@@ -163,7 +226,9 @@ data_manager = Agent(
 """,
     tools=[
         save_meal,
+        save_meals_bulk,
         get_today_meals,
+        get_today_with_goals,
         get_meals_by_date,
         get_week_meals,
         get_user_goals,
@@ -173,6 +238,7 @@ data_manager = Agent(
         calculate_daily_totals,
         # Инструменты для веса
         save_weight,
+        save_weights_bulk,
         get_weight_history,
         get_weight_nutrition_analysis,
         delete_weight,
@@ -235,6 +301,7 @@ root_agent = Agent(
    - СРАЗУ рассчитай КБЖУ и покажи результат В ОДНОМ сообщении
    - Спроси подтверждение на запись
    - Только после "да/ок/запиши" — сохрани через save_meal
+     (несколько приемов пищи сразу — одним вызовом save_meals_bulk)
    - После сохранения покажи прогресс за день
 
 4. ЕСЛИ пользователь спрашивает об ИСТОРИИ ("что я ел вчера?", "статистика за неделю"):
@@ -258,6 +325,8 @@ root_agent = Agent(
 
 8. ЕСЛИ пользователь сообщает ВЕС ("вес 75", "сегодня 74.5 кг", "взвесился — 80"):
    - Сохрани через save_weight(user_id, weight)
+   - Вес за несколько прошлых дней ("вчера 80, позавчера 80.5") — одним вызовом
+     save_weights_bulk со списком {date, weight}
    - ВАЖНО: В один день только ОДНА запись веса! Повторный ввод ПЕРЕЗАПИСЫВАЕТ!
    - Покажи изменение с ПРЕДЫДУЩЕГО ДНЯ (не внутри одного дня)
    - Дай мотивирующий комментарий
@@ -284,6 +353,7 @@ root_agent = Agent(
 
 11. ЕСЛИ нужно УТОЧНИТЬ калорийность незнакомого продукта:
     - Используй search_nutrition_info для поиска в интернете
+    - Если нужно уточнить НЕСКОЛЬКО продуктов — один вызов search_nutrition_info_batch со списком запросов
     - Формат запроса: "калорийность [продукт] КБЖУ на 100г"
     - Используй найденные данные для расчета
 
@@ -315,7 +385,7 @@ root_agent = Agent(
 💡 Инсайт: Вес снижается в соответствии с дефицитом!
 
 ВАЖНО:
-- user_id получай из контекста сессии (используй "default_user" если не указан)
+- user_id текущего пользователя: {user_id?} (если пусто — используй "default_user")
 - Всегда округляй числа до 1 знака после запятой
 - При ошибках сообщай пользователю понятным языком
 - НИКОГДА не говори "сейчас рассчитаю" без результата — ВСЕГДА показывай расчёт СРАЗУ!
@@ -326,7 +396,9 @@ root_agent = Agent(
     tools=[
         # Инструменты для работы с данными
         save_meal,
+        save_meals_bulk,
         get_today_meals,
+        get_today_with_goals,
         get_meals_by_date,
         get_week_meals,
         get_user_goals,
@@ -335,6 +407,7 @@ root_agent = Agent(
         delete_meal,
         # Инструменты для веса
         save_weight,
+        save_weights_bulk,
         get_weight_history,
         get_weight_nutrition_analysis,
         delete_weight,
@@ -348,6 +421,7 @@ root_agent = Agent(
         forget_memory,
         # Поиск информации (вызывает отдельный search_agent внутри)
         search_nutrition_info,
+        search_nutrition_info_batch,
     ],
     # Суб-агенты для делегирования специфических задач
     # search_agent вызывается через search_nutrition_info tool (отдельная сессия)
@@ -4,11 +4,19 @@ Telegram Bot интеграция для Nutrition Tracker
 """
 import os
 import io
+import time
+import importlib
 import asyncio
 import logging
+from dataclasses import dataclass, field
+from typing import Callable, Coroutine, Final, Optional
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
-from telegram import Update
+from PIL import Image
+from telegram import File, Message, PhotoSize, Update
+from telegram.error import BadRequest
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -17,6 +25,7 @@ from telegram.ext import (
     ContextTypes,
 )
 
+from google.adk.agents.run_config import RunConfig, StreamingMode
 from google.adk.runners import Runner
 from google.adk.sessions import InMemorySessionService
 from google.genai import types
@@ -27,11 +36,14 @@ load_dotenv()
 # ID пользователей с доступом к /sync (через запятую в .env)
 ADMIN_USER_IDS = set(filter(None, os.getenv('ADMIN_USER_IDS', '').split(',')))
 
-# Настройка логирования
+# Настройка логирования (LOG_LEVEL=DEBUG в .env — подробный лог событий агента)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG  # Временно для отладки
+    level=LOG_LEVEL
 )
+# basicConfig мог уже вызвать agent.py до загрузки .env — выставляем уровень явно
+logging.getLogger().setLevel(LOG_LEVEL)
 logger = logging.getLogger(__name__)
 # Уменьшим шум от httpx
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -40,30 +52,288 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 _runner = None
 _session_service = None
 
-# Кэш для сбора альбомов (media groups)
-_media_groups: dict[str, list[bytes]] = {}
-_media_group_captions: dict[str, str] = {}
-_media_group_updates: dict[str, Update] = {}
-_media_group_user_ids: dict[str, str] = {}
+# Сессии, которые уже созданы в session service (чтобы не дёргать его на каждое сообщение)
+_created_sessions: set[str] = set()
+_session_locks: dict[str, asyncio.Lock] = {}
 
+# Очереди задач по чатам (см. _enqueue)
+_chat_queues: dict[str, asyncio.Queue] = {}
+_chat_workers: dict[str, asyncio.Task] = {}
+CHAT_WORKER_IDLE_TIMEOUT = 60
 
-def get_runner():
-    """Получает или создает Runner для ADK агента"""
-    global _runner, _session_service
+# Сколько задач разных чатов выполняется одновременно: при всплеске апдейтов
+# остальные ждут в очередях, а не конкурируют за базу и модель
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', '32'))
+_jobs_semaphore = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+
+
+@dataclass(slots=True)
+class MediaGroup:
+    """Альбом, который собирается из отдельных апдейтов"""
+    update: Update          # первый апдейт альбома — на него отвечаем
+    user_id: str
+    caption: Optional[str] = None
+    photos: list[PhotoSize] = field(default_factory=list)  # скачиваются при отправке
+    flush_task: Optional[asyncio.Task] = None
+
+
+# Альбом отправляем агенту, когда новые фото не приходили MEDIA_GROUP_IDLE сек
+MEDIA_GROUP_IDLE = 0.3
+
+# Для распознавания еды хватает 1024px по длинной стороне — большие фото уменьшаем
+PHOTO_MAX_SIDE = 1024
+
+# Результаты get_file: file_id -> File (ссылка Telegram действительна час)
+_file_cache: TTLCache[str, File] = TTLCache(maxsize=1024, ttl=55 * 60)
+
+
+# Кэш для сбора альбомов (media groups). TTL — страховка: если отложенная
+# обработка не забрала альбом, запись не живёт вечно
+_media_groups: TTLCache[str, MediaGroup] = TTLCache(maxsize=1024, ttl=30)
+
+# Стриминг ответа: частичные события от модели приходят по мере генерации
+_STREAM_RUN_CONFIG = RunConfig(streaming_mode=StreamingMode.SSE)
+# Обновляем сообщение не чаще чем раз в 0.5 сек или каждые 200 символов
+STREAM_FLUSH_CHARS = 200
+STREAM_FLUSH_INTERVAL = 0.5
+
+
+class ChatEditLimiter:
+    """
+    Token bucket для edit_text по каждому чату.
+
+    Telegram ограничивает частоту правок сообщений в одном чате (~30 в минуту),
+    при превышении отвечает 429 и заставляет ждать. Вместо этого ждём сами —
+    только в том чате, который упёрся в лимит, остальные чаты не блокируются.
+    """
     
-    if _runner is None:
-        from .agent import root_agent
+    def __init__(self, rate: float = 0.5, capacity: float = 30, idle_ttl: float = 600):
+        self.rate = rate
+        self.capacity = capacity
+        # chat_id -> [tokens, last_refill, lock]. Бакет, простоявший idle_ttl,
+        # давно полон (capacity / rate = 60 сек) — его можно выбросить и
+        # создать заново, поэтому храним в TTLCache, а не копим все чаты
+        self._buckets: TTLCache[int, list] = TTLCache(maxsize=10000, ttl=idle_ttl)
+
+    async def acquire(self, chat_id: int) -> None:
+        """Забирает один токен, при необходимости дожидаясь пополнения"""
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = [self.capacity, time.monotonic(), asyncio.Lock()]
+        # Повторная запись продлевает TTL активного чата
+        self._buckets[chat_id] = bucket
         
-        _session_service = InMemorySessionService()
-        _runner = Runner(
-            agent=root_agent,
-            app_name="nutrition_tracker",
-            session_service=_session_service,
+        async with bucket[2]:
+            now = time.monotonic()
+            tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            if tokens < 1:
+                wait = (1 - tokens) / self.rate
+                await asyncio.sleep(wait)
+                tokens = 1
+                now += wait
+            bucket[0] = tokens - 1
+            bucket[1] = now
+
+
+_edit_limiter = ChatEditLimiter()
+_MARKDOWN_CHARS = frozenset("*_`[")
+
+
+def is_valid_telegram_markdown(text: str) -> bool:
+    """
+    Проверяет, что Telegram распарсит текст как Markdown (legacy, parse_mode='Markdown').
+
+    В legacy Markdown сущности не вкладываются: *жирный*, _курсив_, `код`,
+    ```блок``` и [ссылка](url) должны быть закрыты, а внутри них остальные
+    символы разметки не учитываются. Экранирование — обратным слэшем.
+    """
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch == '\\':
+            i += 2
+        elif text.startswith('```', i):
+            end = text.find('```', i + 3)
+            if end == -1:
+                return False
+            i = end + 3
+        elif ch in '*_`':
+            end = text.find(ch, i + 1)
+            if end == -1:
+                return False
+            i = end + 1
+        elif ch == '[':
+            end = text.find(']', i + 1)
+            if end == -1:
+                return False
+            i = end + 1
+            if text.startswith('(', i):
+                end = text.find(')', i + 1)
+                if end == -1:
+                    return False
+                i = end + 1
+        else:
+            i += 1
+    return True
+
+
+def safe_markdown(text: str) -> tuple[str, Optional[str]]:
+    """
+    Готовит ответ модели к отправке с parse_mode='Markdown'.
+
+    Gemini пишет жирный как **текст** (CommonMark), а legacy Markdown Telegram
+    понимает *текст* — приводим к нему. Если разметка всё равно битая,
+    отправляем исходный текст без форматирования.
+
+    Returns:
+        (text, parse_mode): parse_mode — 'Markdown' или None
+    """
+    normalized = text.replace("**", "*")
+    if is_valid_telegram_markdown(normalized):
+        return normalized, 'Markdown'
+    return text, None
+
+
+async def safe_edit(msg: Message, text: str, parse_mode: str = 'Markdown') -> Message:
+    """
+    Редактирует сообщение с учётом лимита правок в чате.
+
+    Пропускает правку, если текст не изменился. Markdown проверяется заранее:
+    если разметка битая, сразу отправляем plain text без лишнего запроса.
+
+    Returns:
+        Актуальное сообщение (Message неизменяем, поэтому для следующих правок
+        нужно использовать возвращённый объект)
+    """
+    if parse_mode == 'Markdown':
+        text, parse_mode = safe_markdown(text)
+
+    # Текст с разметкой сравниваем только если в нём нет спецсимволов Markdown:
+    # иначе plain-версия с тем же текстом ещё не отформатирована
+    if text == msg.text and (parse_mode is None or not _MARKDOWN_CHARS.intersection(text)):
+        return msg
+
+    await _edit_limiter.acquire(msg.chat_id)
+    try:
+        result = await msg.edit_text(text, parse_mode=parse_mode)
+    except BadRequest as e:
+        # Проверка выше не ловит всё (например, сущность на границе emoji)
+        if parse_mode is None or "parse" not in str(e).lower():
+            raise
+        if text == msg.text:
+            return msg
+        await _edit_limiter.acquire(msg.chat_id)
+        result = await msg.edit_text(text)
+
+    return result if isinstance(result, Message) else msg
+
+
+class CachedSessionService(InMemorySessionService):
+    """
+    InMemorySessionService с кэшем горячих сессий.
+
+    Базовый get_session на каждый вызов делает deepcopy всей сессии вместе
+    с историей событий, а Runner вызывает его на каждое сообщение. Здесь
+    активные сессии держим в TTLCache и отдаём один и тот же объект: события
+    Runner добавляет через append_event прямо в него, так что кэш остаётся
+    актуальным. Пользователи обычно пишут сериями сообщений, а потом надолго
+    пропадают — поэтому TTL, а не бессрочное хранение.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600):
+        super().__init__()
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def create_session(self, *, app_name, user_id, state=None, session_id=None):
+        session = await super().create_session(
+            app_name=app_name, user_id=user_id, state=state, session_id=session_id
         )
+        self._cache[(app_name, user_id, session.id)] = session
+        return session
+
+    async def get_session(self, *, app_name, user_id, session_id, config=None):
+        # Выборка с фильтром событий (config) идёт мимо кэша
+        if config is not None:
+            return await super().get_session(
+                app_name=app_name, user_id=user_id, session_id=session_id, config=config
+            )
+
+        key = (app_name, user_id, session_id)
+        session = self._cache.get(key)
+        if session is None:
+            session = await super().get_session(
+                app_name=app_name, user_id=user_id, session_id=session_id
+            )
+            if session is not None:
+                self._cache[key] = session
+        return session
+
+    async def delete_session(self, *, app_name, user_id, session_id):
+        self._cache.pop((app_name, user_id, session_id), None)
+        await super().delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+
+
+async def init_runner() -> None:
+    """Создает Runner для ADK агента (вызывается один раз при старте бота)"""
+    global _runner, _session_service
+
+    # Импорт агента тянет ADK и открывает SQLite — делаем это в потоке,
+    # чтобы не блокировать event loop
+    agent_module = await asyncio.to_thread(importlib.import_module, ".agent", __package__)
+    root_agent = agent_module.root_agent
     
+    from .tools.memory_tools import init_memory_db
+    await asyncio.to_thread(init_memory_db)
+
+    _session_service = CachedSessionService()
+    _runner = Runner(
+        agent=root_agent,
+        app_name="nutrition_tracker",
+        session_service=_session_service,
+    )
+    logger.info("✅ ADK Runner инициализирован")
+
+
+def get_runner() -> Runner:
+    """Возвращает Runner, созданный в init_runner()"""
     return _runner
 
 
+async def _ensure_session(user_id: str) -> str:
+    """
+    Создаёт сессию пользователя при первом обращении.
+
+    Returns:
+        ID сессии
+    """
+    session_id = f"telegram_{user_id}"
+    if session_id in _created_sessions:
+        return session_id
+
+    # Лок на сессию — чтобы параллельные сообщения не создавали её дважды
+    lock = _session_locks.setdefault(session_id, asyncio.Lock())
+    async with lock:
+        if session_id not in _created_sessions:
+            session = await _session_service.get_session(
+                app_name="nutrition_tracker",
+                user_id=user_id,
+                session_id=session_id
+            )
+            if session is None:
+                # user_id кладём в state — агент подставляет его в инструкцию
+                await _session_service.create_session(
+                    app_name="nutrition_tracker",
+                    user_id=user_id,
+                    session_id=session_id,
+                    state={"user_id": user_id}
+                )
+            _created_sessions.add(session_id)
+    _session_locks.pop(session_id, None)
+
+    return session_id
+
+
 async def run_agent(user_id: str, message: str) -> str:
     """
     Запускает агента для обработки текстового сообщения.
@@ -96,22 +366,46 @@ async def run_agent_multimodal(
     Returns:
         Ответ агента
     """
+    chunks = []
+    final_response = ""
+    async for text, is_final in stream_agent(user_id, message, media_bytes, media_mime_type):
+        if is_final:
+            final_response = text
+            chunks.clear()
+        else:
+            chunks.append(text)
+
+    return final_response or "".join(chunks) or "Не удалось получить ответ. Попробуй еще раз."
+
+
+async def stream_agent(
+    user_id: str,
+    message: str,
+    media_bytes: bytes = None,
+    media_mime_type: str = None,
+    images: list[bytes] = None
+):
+    """
+    Запускает агента и отдаёт ответ по частям, по мере генерации.
+
+    Args:
+        user_id: ID пользователя Telegram
+        message: Текст сообщения
+        media_bytes: Байты медиафайла (фото или аудио)
+        media_mime_type: MIME тип медиа (image/jpeg, audio/ogg и т.д.)
+        images: Несколько JPEG-фото (альбом) — уходят в одном запросе
+
+    Yields:
+        (text, is_final): фрагмент текста (is_final=False) или
+        полный финальный ответ агента (is_final=True)
+    """
     runner = get_runner()
-    session_id = f"telegram_{user_id}"
     
     try:
-        # Создаем или получаем сессию
-        try:
-            await _session_service.create_session(
-                app_name="nutrition_tracker",
-                user_id=user_id,
-                session_id=session_id
-            )
-        except Exception:
-            pass  # Сессия уже существует
+        session_id = await _ensure_session(user_id)
         
         # Формируем parts для Content
-        parts = [types.Part(text=f"[user_id: {user_id}] {message}")]
+        parts = [types.Part(text=message)]
         
         # Добавляем медиа если есть
         if media_bytes and media_mime_type:
@@ -119,50 +413,188 @@ async def run_agent_multimodal(
                 types.Part(
                     inline_data=types.Blob(
                         mime_type=media_mime_type,
-                        data=bytes(media_bytes)
+                        data=media_bytes
+                    )
+                )
+            )
+
+        for img_bytes in images or ():
+            parts.append(
+                types.Part(
+                    inline_data=types.Blob(
+                        mime_type="image/jpeg",
+                        data=img_bytes
                     )
                 )
             )
         
         content = types.Content(role="user", parts=parts)
         
-        # Собираем ответ из async generator
-        final_response = ""
         async for event in runner.run_async(
             session_id=session_id,
             user_id=user_id,
             new_message=content,
+            run_config=_STREAM_RUN_CONFIG,
         ):
             # Логируем все события для отладки
-            logger.debug(f"Event: {type(event).__name__}, is_final: {event.is_final_response()}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Event: %s, partial: %s, is_final: %s",
+                    type(event).__name__, event.partial, event.is_final_response()
+                )
             
-            # Извлекаем текст из любого события с контентом
-            if event.content and event.content.parts:
-                for part in event.content.parts:
-                    if hasattr(part, 'text') and part.text:
-                        # Берём последний текстовый ответ (финальный)
-                        if event.is_final_response():
-                            final_response = part.text
-                        elif not final_response:
-                            # Сохраняем промежуточный если финального ещё нет
-                            final_response = part.text
-        
-        return final_response if final_response else "Не удалось получить ответ. Попробуй еще раз."
+            content = event.content
+            if not (content and content.parts):
+                continue
             
+            if event.partial:
+                # Частичное событие — новые фрагменты текста
+                for part in content.parts:
+                    if part.text:
+                        yield part.text, False
+            elif event.is_final_response():
+                # Финальное событие содержит весь текст ответа — берём первый текстовый part
+                final_text = next((part.text for part in content.parts if part.text), None)
+                if final_text:
+                    yield final_text, True
+            # Остальные события (вызовы и ответы инструментов) текста для пользователя не несут
+
+    except Exception as e:
+        logger.error("Error running agent: %s", e)
+        yield f"Произошла ошибка: {str(e)}", True
+
+
+def _send_status(update: Update, text: str) -> asyncio.Task:
+    """
+    Отправляет статусное сообщение в фоне.
+
+    Запрос к Telegram идёт параллельно с запуском агента — сообщение
+    понадобится только к первой правке.
+    """
+    return asyncio.create_task(update.message.reply_text(text))
+
+
+async def _stream_reply(status_task: asyncio.Task, stream) -> None:
+    """
+    Транслирует ответ агента в статусное сообщение.
+
+    Фрагменты копятся в буфере и отправляются через edit_text не чаще
+    STREAM_FLUSH_INTERVAL или при накоплении STREAM_FLUSH_CHARS символов.
+    Промежуточные правки идут без разметки (незакрытый Markdown не парсится),
+    финальный ответ — с Markdown.
+
+    Args:
+        status_task: Задача из _send_status (статус ещё может отправляться)
+        stream: Генератор stream_agent(...)
+    """
+    chunks = []
+    final_response = ""
+    pending_chars = 0
+    last_flush = time.monotonic()
+    status_msg = None
+
+    async for text, is_final in stream:
+        if is_final:
+            final_response = text
+            chunks.clear()
+            continue
+
+        chunks.append(text)
+        pending_chars += len(text)
+        now = time.monotonic()
+        if pending_chars < STREAM_FLUSH_CHARS and now - last_flush < STREAM_FLUSH_INTERVAL:
+            continue
+
+        try:
+            status_msg = await safe_edit(status_msg or await status_task, "".join(chunks), parse_mode=None)
+        except Exception as e:
+            logger.debug("Skipping intermediate edit: %s", e)
+        pending_chars = 0
+        last_flush = time.monotonic()
+
+    response = final_response or "".join(chunks) or "Не удалось получить ответ. Попробуй еще раз."
+    await safe_edit(status_msg or await status_task, response)
+
+
+async def _answer(status_task: asyncio.Task, stream, error_text: str = "❌ Ошибка") -> None:
+    """Стримит ответ агента в статус, при сбое пишет туда ошибку"""
+    try:
+        await _stream_reply(status_task, stream)
+    except Exception as e:
+        logger.error("Error answering message: %s", e)
+        await safe_edit(await status_task, f"{error_text}: {str(e)}", parse_mode=None)
+
+
+async def _answer_media(
+    status_task: asyncio.Task,
+    download: Coroutine,
+    make_stream: Callable,
+    error_text: str = "❌ Ошибка"
+) -> None:
+    """
+    Скачивает медиа и стримит ответ агента — всё внутри задачи чата.
+
+    Скачивание идёт уже в очереди, поэтому текст, отправленный после фото
+    или голосового, не обгонит их.
+
+    Args:
+        status_task: Задача из _send_status
+        download: Awaitable, возвращающий данные медиа
+        make_stream: Строит stream_agent(...) из скачанных данных
+        error_text: Префикс сообщения об ошибке
+    """
+    try:
+        media = await download
     except Exception as e:
-        logger.error(f"Error running agent: {e}")
-        return f"Произошла ошибка: {str(e)}"
+        logger.error("Error downloading media: %s", e)
+        await safe_edit(await status_task, f"{error_text}: {str(e)}", parse_mode=None)
+        return
+
+    await _answer(status_task, make_stream(media), error_text)
+
+
+def _enqueue(user_id: str, job: Coroutine) -> None:
+    """
+    Ставит задачу в очередь чата.
+
+    Сообщения одного пользователя обрабатываются строго по порядку (общая
+    сессия агента), разные пользователи — параллельно, но не больше
+    MAX_CONCURRENT_JOBS задач одновременно. Воркер чата создаётся
+    при первом сообщении и завершается после простоя.
+    """
+    queue = _chat_queues.get(user_id)
+    if queue is None:
+        queue = _chat_queues[user_id] = asyncio.Queue()
+        _chat_workers[user_id] = asyncio.create_task(_chat_worker(user_id, queue))
+    queue.put_nowait(job)
+
+
+async def _chat_worker(user_id: str, queue: asyncio.Queue) -> None:
+    """Последовательно выполняет задачи из очереди одного чата"""
+    while True:
+        try:
+            job = await asyncio.wait_for(queue.get(), CHAT_WORKER_IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Между проверкой и удалением нет await — новая задача не потеряется
+            if queue.empty():
+                _chat_queues.pop(user_id, None)
+                _chat_workers.pop(user_id, None)
+                return
+            continue
+
+        try:
+            async with _jobs_semaphore:
+                await job
+        except Exception as e:
+            logger.error("Error in chat worker %s: %s", user_id, e)
 
 
 # ============================================================
 # TELEGRAM HANDLERS
 # ============================================================
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start"""
-    user = update.effective_user
-    
-    welcome_msg = f"""👋 *Привет, {user.first_name}!*
+# Тексты /start и /help — константы, собираются один раз при импорте
+WELCOME_TEMPLATE: Final[str] = """👋 *Привет, {first_name}!*
 
 Я NutriTracker — твой AI-помощник по питанию.
 
@@ -190,13 +622,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 Давай начнем! 🚀
 """
-    
-    await update.message.reply_text(welcome_msg, parse_mode='Markdown')
-
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /help"""
-    help_text = """📖 *Справка NutriTracker*
+HELP_TEXT: Final[str] = """📖 *Справка NutriTracker*
 
 *Добавление еды (3 способа):*
 
@@ -227,59 +654,59 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 💡 Бот использует Gemini AI для анализа фото, аудио и текста.
 """
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /start"""
+    user = update.effective_user
+
+    welcome_msg = WELCOME_TEMPLATE.format_map({"first_name": escape_markdown(user.first_name)})
+    await update.message.reply_text(
+        welcome_msg, parse_mode='Markdown', disable_web_page_preview=True
+    )
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /help"""
+    await update.message.reply_text(
+        HELP_TEXT, parse_mode='Markdown', disable_web_page_preview=True
+    )
 
 
 async def today_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /today"""
     user_id = str(update.effective_user.id)
     
-    status_msg = await update.message.reply_text("🔍 Загружаю данные...")
-    response = await run_agent(user_id, "Покажи что я съел сегодня и прогресс к целям")
-    try:
-        await status_msg.edit_text(response, parse_mode='Markdown')
-    except Exception:
-        await status_msg.edit_text(response)
+    status_task = _send_status(update, "🔍 Загружаю данные...")
+    _enqueue(user_id, _answer(status_task, stream_agent(user_id, "Покажи что я съел сегодня и прогресс к целям")))
 
 
 async def week_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /week"""
     user_id = str(update.effective_user.id)
     
-    status_msg = await update.message.reply_text("📊 Собираю статистику за неделю...")
-    response = await run_agent(user_id, "Покажи статистику питания за последнюю неделю")
-    try:
-        await status_msg.edit_text(response, parse_mode='Markdown')
-    except Exception:
-        await status_msg.edit_text(response)
+    status_task = _send_status(update, "📊 Собираю статистику за неделю...")
+    _enqueue(user_id, _answer(status_task, stream_agent(user_id, "Покажи статистику питания за последнюю неделю")))
 
 
 async def goals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /goals"""
     user_id = str(update.effective_user.id)
     
-    status_msg = await update.message.reply_text("🎯 Загружаю цели...")
-    response = await run_agent(user_id, "Покажи мои текущие цели по питанию")
-    try:
-        await status_msg.edit_text(response, parse_mode='Markdown')
-    except Exception:
-        await status_msg.edit_text(response)
+    status_task = _send_status(update, "🎯 Загружаю цели...")
+    _enqueue(user_id, _answer(status_task, stream_agent(user_id, "Покажи мои текущие цели по питанию")))
 
 
 async def undo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /undo"""
     user_id = str(update.effective_user.id)
     
-    status_msg = await update.message.reply_text("🗑 Удаляю...")
-    response = await run_agent(user_id, "Отмени последний прием пищи")
-    try:
-        await status_msg.edit_text(response, parse_mode='Markdown')
-    except Exception:
-        await status_msg.edit_text(response)
+    status_task = _send_status(update, "🗑 Удаляю...")
+    _enqueue(user_id, _answer(status_task, stream_agent(user_id, "Отмени последний прием пищи")))
 
 
 async def sync_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /sync — синхронизация в Google Sheets"""
+    """Обработчик команды /sync — синхронизация в Google Sheets (/sync full — сверить всё заново)"""
     user_id = str(update.effective_user.id)
     
     # Ограничиваем доступ если ADMIN_USER_IDS задан
@@ -291,10 +718,13 @@ async def sync_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         from .tools.sheets_tools import sync_from_sqlite
-        result = sync_from_sqlite()
-        await status_msg.edit_text(result["message"])
+        # Синхронизация — десятки блокирующих запросов к SQLite и Sheets API,
+        # выполняем в потоке, чтобы не останавливать остальные чаты
+        full = bool(context.args) and context.args[0].lower() == "full"
+        result = await asyncio.to_thread(sync_from_sqlite, full)
+        await safe_edit(status_msg, result["message"], parse_mode=None)
     except Exception as e:
-        await status_msg.edit_text(f"❌ Ошибка: {str(e)}")
+        await safe_edit(status_msg, f"❌ Ошибка: {str(e)}", parse_mode=None)
 
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -303,92 +733,133 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     
     # Показываем что обрабатываем
-    status_msg = await update.message.reply_text("🔍 Обрабатываю...")
+    status_task = _send_status(update, "🔍 Обрабатываю...")
     
-    try:
-        response = await run_agent(user_id, text)
-        # Пробуем отправить с Markdown, если не получится - без форматирования
-        try:
-            await status_msg.edit_text(response, parse_mode='Markdown')
-        except Exception:
-            # Markdown не распарсился - отправляем plain text
-            await status_msg.edit_text(response)
-    except Exception as e:
-        logger.error(f"Error handling text: {e}")
-        await status_msg.edit_text(f"❌ Ошибка: {str(e)}")
+    _enqueue(user_id, _answer(status_task, stream_agent(user_id, text)))
 
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик фотографий — поддержка альбомов (несколько фото одного блюда)"""
+    _media_groups.expire()
+
     user_id = str(update.effective_user.id)
     media_group_id = update.message.media_group_id
     caption = update.message.caption
-    
-    # Скачиваем фото (максимальное разрешение)
-    photo = update.message.photo[-1]
-    photo_file = await context.bot.get_file(photo.file_id)
-    photo_bytes = bytes(await photo_file.download_as_bytearray())
+    # Наименьший вариант фото, которого хватает для распознавания
+    photo = _pick_photo_size(update.message.photo)
     
     if media_group_id:
-        # Это альбом — собираем все фото
-        if media_group_id not in _media_groups:
-            _media_groups[media_group_id] = []
-            _media_group_updates[media_group_id] = update
-            _media_group_user_ids[media_group_id] = user_id
-            if caption:
-                _media_group_captions[media_group_id] = caption
-            # Запускаем отложенную обработку
-            asyncio.create_task(
-                _process_media_group_delayed(media_group_id, context)
-            )
-        
-        _media_groups[media_group_id].append(photo_bytes)
+        # Это альбом — запоминаем фото, скачаем все разом при отправке.
+        # Ветка без await, поэтому в одном event loop она атомарна и лок не нужен
+        group = _media_groups.get(media_group_id)
+        if group is None:
+            group = _media_groups[media_group_id] = MediaGroup(update=update, user_id=user_id)
+        group.photos.append(photo)
         # Сохраняем caption если есть (может быть на любом фото альбома)
-        if caption and media_group_id not in _media_group_captions:
-            _media_group_captions[media_group_id] = caption
+        if caption and not group.caption:
+            group.caption = caption
+        # Перезапускаем таймер: альбом уходит после паузы без новых фото
+        if group.flush_task:
+            group.flush_task.cancel()
+        group.flush_task = asyncio.create_task(
+            _process_media_group_delayed(media_group_id, context)
+        )
     else:
-        # Одиночное фото — обрабатываем сразу
-        await _process_single_photo(user_id, photo_bytes, caption, update, context)
+        # Одиночное фото — сразу в очередь чата, скачается там же
+        _process_single_photo(user_id, photo, caption, update, context)
+
+
+async def _get_file(bot, file_id: str) -> File:
+    """
+    get_file с кэшем: ссылка на скачивание живёт не меньше часа, поэтому
+    повторно присланный файл (пересланное фото, повтор альбома) не требует
+    лишнего запроса к Bot API.
+    """
+    file = _file_cache.get(file_id)
+    if file is None:
+        file = _file_cache[file_id] = await bot.get_file(file_id)
+    return file
+
+
+async def _download_media(bot, file_id: str) -> bytes:
+    """
+    Скачивает файл Telegram сразу в память.
+    BytesIO.getvalue() отдаёт собственный буфер без копии, поэтому байты
+    попадают в types.Blob без промежуточного bytearray.
+    """
+    tg_file = await _get_file(bot, file_id)
+    buf = io.BytesIO()
+    await tg_file.download_to_memory(buf)
+    return buf.getvalue()
+
+
+async def _download_photo(bot, photo: PhotoSize) -> bytes:
+    """Скачивает фото и при необходимости уменьшает до PHOTO_MAX_SIDE"""
+    photo_bytes = await _download_media(bot, photo.file_id)
+    if max(photo.width, photo.height) > PHOTO_MAX_SIDE:
+        photo_bytes = await asyncio.to_thread(_shrink_photo, photo_bytes)
+    return photo_bytes
+
+
+def _pick_photo_size(sizes: tuple[PhotoSize, ...]) -> PhotoSize:
+    """
+    Выбирает вариант фото для модели: наименьший, у которого длинная сторона
+    не меньше PHOTO_MAX_SIDE, иначе самый большой из доступных.
+    Telegram отдаёт варианты по возрастанию размера.
+    """
+    for size in sizes:
+        if max(size.width, size.height) >= PHOTO_MAX_SIDE:
+            return size
+    return sizes[-1]
+
+
+def _shrink_photo(data: bytes) -> bytes:
+    """Уменьшает фото до PHOTO_MAX_SIDE по длинной стороне и пережимает в JPEG"""
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+        out = io.BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+    return out.getvalue()
 
 
 async def _process_media_group_delayed(
     media_group_id: str, 
     context: ContextTypes.DEFAULT_TYPE
 ):
-    """Ждём 1.5 сек пока все фото альбома придут, потом обрабатываем"""
-    await asyncio.sleep(1.5)
+    """Ждём MEDIA_GROUP_IDLE сек без новых фото, потом отправляем альбом агенту"""
+    await asyncio.sleep(MEDIA_GROUP_IDLE)
     
-    photos = _media_groups.pop(media_group_id, [])
-    caption = _media_group_captions.pop(media_group_id, None)
-    update = _media_group_updates.pop(media_group_id, None)
-    user_id = _media_group_user_ids.pop(media_group_id, None)
-    
-    if not photos or not update or not user_id:
+    group = _media_groups.pop(media_group_id, None)
+    if group is None or not group.photos:
         return
     
-    status_msg = await update.message.reply_text(
-        f"📸 Анализирую {len(photos)} фото блюда..."
-    )
-    
-    try:
-        # Формируем prompt
-        prompt = caption or f"Это {len(photos)} фото одного блюда с разных ракурсов. Распознай блюдо, определи порцию, посчитай КБЖУ."
-        
-        # Отправляем все фото в одном запросе
-        response = await _run_agent_with_multiple_images(user_id, prompt, photos)
-        
-        try:
-            await status_msg.edit_text(response, parse_mode='Markdown')
-        except Exception:
-            await status_msg.edit_text(response)
-    except Exception as e:
-        logger.error(f"Error processing media group: {e}")
-        await status_msg.edit_text(f"❌ Ошибка: {str(e)}")
+    photos = group.photos
+    caption = group.caption
+    update = group.update
+    user_id = group.user_id
+
+    status_task = _send_status(update, f"📸 Анализирую {len(photos)} фото блюда...")
+
+    # Формируем prompt
+    prompt = caption or f"Это {len(photos)} фото одного блюда с разных ракурсов. Распознай блюдо, определи порцию, посчитай КБЖУ."
 
+    async def download_all() -> list[bytes]:
+        # Все фото альбома качаем параллельно
+        return list(await asyncio.gather(
+            *(_download_photo(context.bot, photo) for photo in photos)
+        ))
 
-async def _process_single_photo(
+    # Скачиваем уже в очереди чата и отправляем все фото в одном запросе
+    _enqueue(user_id, _answer_media(
+        status_task,
+        download_all(),
+        lambda images: stream_agent(user_id, prompt, images=images)
+    ))
+
+
+def _process_single_photo(
     user_id: str, 
-    photo_bytes: bytes, 
+    photo: PhotoSize,
     caption: str,
     update: Update, 
     context: ContextTypes.DEFAULT_TYPE
@@ -396,107 +867,56 @@ async def _process_single_photo(
     """Обработка одиночного фото"""
     prompt = caption or "Распознай еду на этом фото, определи порцию, посчитай калории и БЖУ."
     
-    status_msg = await update.message.reply_text("📸 Анализирую фото...")
-    
-    try:
-        response = await run_agent_multimodal(
+    status_task = _send_status(update, "📸 Анализирую фото...")
+    _enqueue(user_id, _answer_media(
+        status_task,
+        _download_photo(context.bot, photo),
+        lambda photo_bytes: stream_agent(
             user_id, prompt,
             media_bytes=photo_bytes,
             media_mime_type="image/jpeg"
-        )
-        
-        try:
-            await status_msg.edit_text(response, parse_mode='Markdown')
-        except Exception:
-            await status_msg.edit_text(response)
-    except Exception as e:
-        logger.error(f"Error handling photo: {e}")
-        await status_msg.edit_text(f"❌ Ошибка обработки фото: {str(e)}")
-
-
-async def _run_agent_with_multiple_images(
-    user_id: str, 
-    message: str, 
-    images: list[bytes]
-) -> str:
-    """Запускает агента с несколькими изображениями"""
-    runner = get_runner()
-    session_id = f"telegram_{user_id}"
-    
-    try:
-        try:
-            await _session_service.create_session(
-                app_name="nutrition_tracker",
-                user_id=user_id,
-                session_id=session_id
-            )
-        except Exception:
-            pass
-        
-        # Формируем parts: текст + все изображения
-        parts = [types.Part(text=f"[user_id: {user_id}] {message}")]
-        
-        for img_bytes in images:
-            parts.append(
-                types.Part(
-                    inline_data=types.Blob(
-                        mime_type="image/jpeg",
-                        data=img_bytes
-                    )
-                )
-            )
-        
-        content = types.Content(role="user", parts=parts)
-        
-        final_response = ""
-        async for event in runner.run_async(
-            session_id=session_id,
-            user_id=user_id,
-            new_message=content,
-        ):
-            if event.content and event.content.parts:
-                for part in event.content.parts:
-                    if hasattr(part, 'text') and part.text:
-                        if event.is_final_response():
-                            final_response = part.text
-                        elif not final_response:
-                            final_response = part.text
-        
-        return final_response if final_response else "Не удалось получить ответ."
-            
-    except Exception as e:
-        logger.error(f"Error running agent with images: {e}")
-        return f"Произошла ошибка: {str(e)}"
+        ),
+        error_text="❌ Ошибка обработки фото"
+    ))
 
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик голосовых сообщений — расшифровывает аудио через Gemini"""
     user_id = str(update.effective_user.id)
     
-    status_msg = await update.message.reply_text("🎤 Расшифровываю голосовое...")
-    
-    try:
-        # Получаем голосовое сообщение
-        voice = update.message.voice
-        voice_file = await context.bot.get_file(voice.file_id)
-        voice_bytes = await voice_file.download_as_bytearray()
-        
-        # Передаём аудио напрямую в агента (Gemini Audio)
-        response = await run_agent_multimodal(
+    status_task = _send_status(update, "🎤 Расшифровываю голосовое...")
+
+    # Голосовое скачивается в очереди чата и передаётся напрямую в агента (Gemini Audio)
+    _enqueue(user_id, _answer_media(
+        status_task,
+        _download_media(context.bot, update.message.voice.file_id),
+        lambda voice_bytes: stream_agent(
             user_id,
             "Расшифруй это голосовое сообщение. Пользователь описывает еду. "
             "Проанализируй, посчитай калории и БЖУ, сохрани в дневник.",
             media_bytes=voice_bytes,
             media_mime_type="audio/ogg"
         )
-        
-        try:
-            await status_msg.edit_text(response, parse_mode='Markdown')
-        except Exception:
-            await status_msg.edit_text(response)
-    except Exception as e:
-        logger.error(f"Error handling voice: {e}")
-        await status_msg.edit_text(f"❌ Ошибка: {str(e)}")
+    ))
+
+
+def _register_handlers(application: Application) -> None:
+    """Регистрирует обработчики команд и сообщений (один раз на приложение)"""
+    handlers = [
+        # Команды
+        CommandHandler("start", start),
+        CommandHandler("help", help_command),
+        CommandHandler("today", today_command),
+        CommandHandler("week", week_command),
+        CommandHandler("goals", goals_command),
+        CommandHandler("undo", undo_command),
+        CommandHandler("sync", sync_command),
+        # Сообщения
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text),
+        MessageHandler(filters.PHOTO, handle_photo),
+        MessageHandler(filters.VOICE, handle_voice),
+    ]
+    application.add_handlers(handlers)
 
 
 def create_bot() -> Application:
@@ -506,22 +926,21 @@ def create_bot() -> Application:
     if not token:
         raise ValueError("TELEGRAM_BOT_TOKEN не найден в переменных окружения!")
     
-    # Создаем приложение
-    application = Application.builder().token(token).build()
-    
-    # Регистрируем обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("today", today_command))
-    application.add_handler(CommandHandler("week", week_command))
-    application.add_handler(CommandHandler("goals", goals_command))
-    application.add_handler(CommandHandler("undo", undo_command))
-    application.add_handler(CommandHandler("sync", sync_command))
+    # Создаем приложение с post_init для правильной инициализации.
+    # Апдейты разных пользователей обрабатываются параллельно, запросы к Bot API
+    # идут через общий пул HTTP/2 соединений
+    application = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(True)
+        .http_version("2")
+        .connection_pool_size(256)
+        .pool_timeout(10)
+        .post_init(post_init)
+        .build()
+    )
     
-    # Регистрируем обработчики сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.VOICE, handle_voice))
+    _register_handlers(application)
     
     return application
 
@@ -529,6 +948,8 @@ def create_bot() -> Application:
 async def post_init(application):
     """Инициализация бота после создания"""
     await application.bot.initialize()
+    # Агент поднимаем до начала polling, а не на первом сообщении
+    await init_runner()
 
 
 def main():
@@ -543,39 +964,14 @@ def main():
     """)
     
     try:
-        token = os.getenv('TELEGRAM_BOT_TOKEN')
-        if not token:
-            raise ValueError("TELEGRAM_BOT_TOKEN не найден в переменных окружения!")
-        
-        # Создаем приложение с post_init для правильной инициализации
-        application = (
-            Application.builder()
-            .token(token)
-            .post_init(post_init)
-            .build()
-        )
-        
-        # Регистрируем обработчики команд
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("today", today_command))
-        application.add_handler(CommandHandler("week", week_command))
-        application.add_handler(CommandHandler("goals", goals_command))
-        application.add_handler(CommandHandler("undo", undo_command))
-        application.add_handler(CommandHandler("sync", sync_command))
-        
-        # Регистрируем обработчики сообщений
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-        application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-        application.add_handler(MessageHandler(filters.VOICE, handle_voice))
+        application = create_bot()
         
         logger.info("🚀 Запуск Telegram бота...")
         application.run_polling(allowed_updates=Update.ALL_TYPES)
     except Exception as e:
-        logger.error(f"❌ Ошибка запуска: {e}")
+        logger.error("❌ Ошибка запуска: %s", e)
         raise
 
 
 if __name__ == "__main__":
     main()
-
@@ -9,25 +9,68 @@ Long-term Memory (Memory Bank) для агентов.
 - fact: прочие факты ("готовит на неделю вперед")
 """
 import sqlite3
+import copy
 import json
+import atexit
+import threading
+from collections import defaultdict
 from datetime import datetime
 from typing import Optional
 import os
 
+from cachetools import TTLCache
+
 # Путь к базе данных
 DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'nutrition.db')
 
+# Одно подключение на процесс: инструменты вызываются из разных потоков,
+# поэтому доступ к нему сериализуем через лок
+_conn: Optional[sqlite3.Connection] = None
+_conn_lock = threading.RLock()
+
+# Кэш recall_memories: память читается почти на каждом ходу агента,
+# а меняется редко. Ключ — (user_id, memory_type), сбрасывается в store/forget
+_recall_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
 
 def _get_connection():
-    """Получает подключение к SQLite"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """
+    Возвращает общее подключение к SQLite (создаётся при первом вызове).
+    Вызывать только под _conn_lock.
+    """
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # WAL: читатели не блокируют писателя (база общая с sqlite_tools)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=134217728")
+        # Схема проверяется один раз — при открытии подключения, а не при импорте
+        _init_memory_table(conn)
+        atexit.register(conn.close)
+        _conn = conn
+    return _conn
+
+
+def init_memory_db():
+    """
+    Открывает подключение и создаёт таблицу памяти, если её нет.
+    Вызывается при старте бота; без этого всё произойдёт при первом обращении.
+    """
+    with _conn_lock:
+        _get_connection()
+
+
+def _invalidate_recall_cache(user_id: str):
+    """Сбрасывает закэшированные воспоминания пользователя. Вызывать под _conn_lock."""
+    for key in [key for key in _recall_cache if key[0] == user_id]:
+        _recall_cache.pop(key, None)
 
 
-def _init_memory_table():
+def _init_memory_table(conn: sqlite3.Connection):
     """Инициализирует таблицу памяти если её нет"""
-    conn = _get_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -48,12 +91,31 @@ def _init_memory_table():
         ON memory_bank(user_id)
     ''')
     
+    # Индекс для recall_memories с фильтром по типу
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_memory_user_type 
+        ON memory_bank(user_id, memory_type)
+    ''')
+    
+    # Один и тот же факт у пользователя хранится один раз — store_memory
+    # полагается на это ограничение вместо SELECT перед INSERT
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_memory_unique'"
+    )
+    if cursor.fetchone() is None:
+        # Старые базы могли накопить дубли — оставляем самую раннюю запись
+        cursor.execute('''
+            DELETE FROM memory_bank
+            WHERE id NOT IN (
+                SELECT MIN(id) FROM memory_bank GROUP BY user_id, content
+            )
+        ''')
+        cursor.execute('''
+            CREATE UNIQUE INDEX idx_memory_unique 
+            ON memory_bank(user_id, content)
+        ''')
+    
     conn.commit()
-    conn.close()
-
-
-# Инициализируем таблицу при импорте
-_init_memory_table()
 
 
 def store_memory(
@@ -80,31 +142,30 @@ def store_memory(
         store_memory("123", "habit", "обычно завтракает в 8 утра")
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        # Проверяем, нет ли уже такой записи
-        cursor.execute('''
-            SELECT id FROM memory_bank 
-            WHERE user_id = ? AND content = ?
-        ''', (user_id, content))
-        
-        existing = cursor.fetchone()
-        if existing:
-            conn.close()
-            return {
-                "status": "exists",
-                "message": f"Это уже запомнено: {content}"
-            }
-        
-        cursor.execute('''
-            INSERT INTO memory_bank (user_id, memory_type, content, metadata)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, memory_type, content, metadata or "{}"))
-        
-        memory_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with _conn_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            
+            # with conn: commit при успехе, rollback при ошибке —
+            # на общем подключении незавершённая транзакция не должна оставаться
+            with conn:
+                # Дубль (user_id, content) отсекает уникальный индекс — тогда RETURNING пуст
+                cursor.execute('''
+                    INSERT OR IGNORE INTO memory_bank (user_id, memory_type, content, metadata)
+                    VALUES (?, ?, ?, ?)
+                    RETURNING id
+                ''', (user_id, memory_type, content, metadata or "{}"))
+                inserted = cursor.fetchone()
+            
+            if inserted is None:
+                return {
+                    "status": "exists",
+                    "message": f"Это уже запомнено: {content}"
+                }
+            
+            (memory_id,) = inserted
+            _invalidate_recall_cache(user_id)
         
         return {
             "status": "success",
@@ -135,60 +196,39 @@ def recall_memories(user_id: str, memory_type: Optional[str] = None) -> dict:
         recall_memories("123")  # все воспоминания
         recall_memories("123", "allergy")  # только аллергии
     """
+    key = (user_id, memory_type or None)
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        if memory_type:
-            cursor.execute('''
-                SELECT id, memory_type, content, created_at 
-                FROM memory_bank
-                WHERE user_id = ? AND memory_type = ?
-                ORDER BY created_at DESC
-            ''', (user_id, memory_type))
-        else:
-            cursor.execute('''
-                SELECT id, memory_type, content, created_at 
-                FROM memory_bank
-                WHERE user_id = ?
-                ORDER BY memory_type, created_at DESC
-            ''', (user_id,))
+        # Чтение и запись в кэш под одним локом — store/forget не успеют
+        # изменить память между запросом и кэшированием
+        with _conn_lock:
+            cached = _recall_cache.get(key)
+            if cached is not None:
+                return copy.deepcopy(cached)
+            
+            conn = _get_connection()
+            cursor = conn.cursor()
+            # Строки разбираются по позиции — sqlite3.Row здесь не нужен
+            cursor.row_factory = None
+            
+            if memory_type:
+                cursor.execute('''
+                    SELECT id, memory_type, content, created_at 
+                    FROM memory_bank
+                    WHERE user_id = ? AND memory_type = ?
+                    ORDER BY created_at DESC
+                ''', (user_id, memory_type))
+            else:
+                cursor.execute('''
+                    SELECT id, memory_type, content, created_at 
+                    FROM memory_bank
+                    WHERE user_id = ?
+                    ORDER BY memory_type, created_at DESC
+                ''', (user_id,))
+            
+            result = _build_recall_result(cursor.fetchall())
+            _recall_cache[key] = result
         
-        rows = cursor.fetchall()
-        conn.close()
-        
-        if not rows:
-            return {
-                "status": "success",
-                "message": "Пока ничего не запомнено о пользователе",
-                "memories": [],
-                "count": 0
-            }
-        
-        memories = []
-        for row in rows:
-            memories.append({
-                "id": row["id"],
-                "type": row["memory_type"],
-                "content": row["content"],
-                "created_at": row["created_at"]
-            })
-        
-        # Группируем для красивого вывода
-        by_type = {}
-        for m in memories:
-            t = m["type"]
-            if t not in by_type:
-                by_type[t] = []
-            by_type[t].append(m["content"])
-        
-        return {
-            "status": "success",
-            "memories": memories,
-            "by_type": by_type,
-            "count": len(memories),
-            "summary": _format_memory_summary(by_type)
-        }
+        return copy.deepcopy(result)
     except Exception as e:
         return {
             "status": "error",
@@ -196,10 +236,37 @@ def recall_memories(user_id: str, memory_type: Optional[str] = None) -> dict:
         }
 
 
+def _build_recall_result(rows: list) -> dict:
+    """Собирает ответ recall_memories из кортежей (id, memory_type, content, created_at)"""
+    if not rows:
+        return {
+            "status": "success",
+            "message": "Пока ничего не запомнено о пользователе",
+            "memories": [],
+            "count": 0
+        }
+    
+    memories = [
+        {"id": memory_id, "type": mem_type, "content": content, "created_at": created_at}
+        for memory_id, mem_type, content, created_at in rows
+    ]
+    
+    # Группируем для красивого вывода
+    by_type = defaultdict(list)
+    for m in memories:
+        by_type[m["type"]].append(m["content"])
+    
+    return {
+        "status": "success",
+        "memories": memories,
+        "by_type": dict(by_type),
+        "count": len(memories),
+        "summary": _format_memory_summary(by_type)
+    }
+
+
 def _format_memory_summary(by_type: dict) -> str:
     """Форматирует воспоминания в читаемую строку"""
-    parts = []
-    
     type_labels = {
         "preference": "🍽️ Предпочтения",
         "allergy": "⚠️ Аллергии/непереносимости",
@@ -207,12 +274,10 @@ def _format_memory_summary(by_type: dict) -> str:
         "fact": "📝 Факты"
     }
     
-    for mem_type, items in by_type.items():
-        label = type_labels.get(mem_type, mem_type)
-        items_str = ", ".join(items)
-        parts.append(f"{label}: {items_str}")
-    
-    return "\n".join(parts)
+    return "\n".join(
+        f"{type_labels.get(mem_type, mem_type)}: {', '.join(items)}"
+        for mem_type, items in by_type.items()
+    )
 
 
 def forget_memory(user_id: str, content_substring: str) -> dict:
@@ -231,35 +296,30 @@ def forget_memory(user_id: str, content_substring: str) -> dict:
         forget_memory("123", "лактоз")  # удалит "непереносимость лактозы"
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        # Сначала находим что будем удалять
-        cursor.execute('''
-            SELECT id, content FROM memory_bank 
-            WHERE user_id = ? AND content LIKE ?
-        ''', (user_id, f"%{content_substring}%"))
-        
-        rows = cursor.fetchall()
+        with _conn_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            
+            # Удаляем и сразу получаем удалённое — один запрос вместо SELECT + DELETE
+            with conn:
+                cursor.execute('''
+                    DELETE FROM memory_bank 
+                    WHERE user_id = ? AND content LIKE ?
+                    RETURNING content
+                ''', (user_id, f"%{content_substring}%"))
+                rows = cursor.fetchall()
+            if rows:
+                _invalidate_recall_cache(user_id)
         
         if not rows:
-            conn.close()
             return {
                 "status": "not_found",
                 "message": f"Не нашёл воспоминаний содержащих '{content_substring}'"
             }
         
-        # Удаляем
-        cursor.execute('''
-            DELETE FROM memory_bank 
-            WHERE user_id = ? AND content LIKE ?
-        ''', (user_id, f"%{content_substring}%"))
-        
-        deleted_count = cursor.rowcount
-        deleted_items = [row["content"] for row in rows]
-        
-        conn.commit()
-        conn.close()
+        deleted_items = [content for (content,) in rows]
+        deleted_count = len(deleted_items)
         
         return {
             "status": "success",
@@ -4,8 +4,70 @@ Tools для анализа питания.
 """
 from datetime import datetime
 import json
+from operator import itemgetter
 from typing import Any
 
+# orjson (если установлен) разбирает JSON заметно быстрее стандартного json;
+# его JSONDecodeError наследуется от json.JSONDecodeError
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+
+# Текущее время для совета: привязки на уровне модуля, без поиска атрибутов при вызове
+_now = datetime.now
+_TIME_FORMAT = "%H:%M"
+
+# КБЖУ приёма пищи одним вызовом на C; отсутствующие поля считаются нулями
+_get_macros = itemgetter("calories", "protein", "fat", "carbs")
+_ZERO_MACROS = {"calories": 0, "protein": 0, "fat": 0, "carbs": 0}
+
+
+def _meal_macros(meal: dict) -> tuple:
+    """Возвращает (calories, protein, fat, carbs) приёма пищи"""
+    try:
+        return _get_macros(meal)
+    except KeyError:
+        # Модель не прислала часть полей — дополняем нулями
+        return _get_macros({**_ZERO_MACROS, **meal})
+
+
+# Статус дня по проценту калорий: до 80%, 80–100%, больше 100%
+_ADVICE_STATUS = (
+    ("in_progress", "🟢"),
+    ("almost_done", "🟡"),
+    ("exceeded", "🔴"),
+)
+
+# Шаблон инструкции для get_nutrition_advice: текст неизменен, подставляются только числа
+_ADVICE_INSTRUCTION = """
+        На основе прогресса пользователя дай краткую рекомендацию:
+        
+        - Прогресс по калориям: {cal_percent:.0f}% ({cal_consumed:.0f}/{cal_goal})
+        - Осталось калорий: {cal_remaining:.0f}
+        - Прогресс по белку: {protein_percent:.0f}% 
+        - Осталось белка: {protein_remaining:.0f}г
+        - Цель пользователя: {goal_type}
+        - Время: {current_time}
+        
+        Дай конкретную рекомендацию что съесть дальше.
+        Будь позитивным и мотивирующим.
+        """
+
+
+# Текст инструкции analyze_food_description — строка неизменяема, собирается один раз
+_ANALYZE_INSTRUCTION = """
+        Проанализируй описание еды и определи:
+        1. Какие продукты/блюда упомянуты
+        2. Примерные порции (в граммах)
+        3. Рассчитай КБЖУ для каждого продукта
+        4. Определи тип приема пищи (breakfast/lunch/dinner/snack)
+        
+        Используй свои знания о калорийности продуктов.
+        Если размер порции не указан - используй стандартную порцию.
+        """
+
 
 def analyze_food_description(food_description: str) -> dict:
     """
@@ -23,21 +85,13 @@ def analyze_food_description(food_description: str) -> dict:
     return {
         "status": "needs_analysis",
         "input": food_description,
-        "instruction": """
-        Проанализируй описание еды и определи:
-        1. Какие продукты/блюда упомянуты
-        2. Примерные порции (в граммах)
-        3. Рассчитай КБЖУ для каждого продукта
-        4. Определи тип приема пищи (breakfast/lunch/dinner/snack)
-        
-        Используй свои знания о калорийности продуктов.
-        Если размер порции не указан - используй стандартную порцию.
-        """,
+        "instruction": _ANALYZE_INSTRUCTION,
+        # Словарь собирается на каждый вызов — ответ можно менять без последствий
         "expected_output": {
             "foods": ["список распознанных продуктов"],
             "total_calories": "число",
             "total_protein": "число в граммах",
-            "total_fat": "число в граммах", 
+            "total_fat": "число в граммах",
             "total_carbs": "число в граммах",
             "meal_type": "breakfast/lunch/dinner/snack",
             "confidence": "high/medium/low"
@@ -58,7 +112,7 @@ def calculate_daily_totals(meals_data_json: str) -> dict:
         dict: Суммарные показатели
     """
     try:
-        meals_data = json.loads(meals_data_json) if isinstance(meals_data_json, str) else meals_data_json
+        meals_data = _json_loads(meals_data_json) if isinstance(meals_data_json, (str, bytes)) else meals_data_json
     except json.JSONDecodeError:
         return {"status": "error", "message": "Invalid JSON format for meals_data"}
     
@@ -74,26 +128,21 @@ def calculate_daily_totals(meals_data_json: str) -> dict:
             "meals_count": 0
         }
     
-    totals = {
-        "calories": 0,
-        "protein": 0,
-        "fat": 0,
-        "carbs": 0
-    }
-    
-    for meal in meals_data:
-        totals["calories"] += meal.get("calories", 0)
-        totals["protein"] += meal.get("protein", 0)
-        totals["fat"] += meal.get("fat", 0)
-        totals["carbs"] += meal.get("carbs", 0)
+    # Один проход с локальными накопителями — без промежуточных кортежей и записей в dict
+    calories = protein = fat = carbs = 0
+    for meal_calories, meal_protein, meal_fat, meal_carbs in map(_meal_macros, meals_data):
+        calories += meal_calories
+        protein += meal_protein
+        fat += meal_fat
+        carbs += meal_carbs
     
     return {
         "status": "success",
         "totals": {
-            "calories": round(totals["calories"], 1),
-            "protein": round(totals["protein"], 1),
-            "fat": round(totals["fat"], 1),
-            "carbs": round(totals["carbs"], 1)
+            "calories": round(calories, 1),
+            "protein": round(protein, 1),
+            "fat": round(fat, 1),
+            "carbs": round(carbs, 1)
         },
         "meals_count": len(meals_data)
     }
@@ -116,27 +165,31 @@ def get_nutrition_advice(
         dict: Структура с данными для генерации рекомендаций
     """
     goals = user_goals.get("goals", user_goals)
+    goal_type = goals.get("goal_type", "maintenance")
     
     cal_consumed = current_totals.get("calories", 0)
     cal_goal = goals.get("daily_calories", 2000)
-    cal_remaining = max(0, cal_goal - cal_consumed)
-    cal_percent = (cal_consumed / cal_goal * 100) if cal_goal > 0 else 0
-    
     protein_consumed = current_totals.get("protein", 0)
     protein_goal = goals.get("daily_protein", 150)
-    protein_remaining = max(0, protein_goal - protein_consumed)
-    protein_percent = (protein_consumed / protein_goal * 100) if protein_goal > 0 else 0
     
-    # Определяем статус
-    if cal_percent > 100:
-        status = "exceeded"
-        emoji = "🔴"
-    elif cal_percent > 80:
-        status = "almost_done"
-        emoji = "🟡"
+    if not cal_consumed and not protein_consumed:
+        # Частый случай — за день ещё ничего не съедено: остаток равен цели
+        cal_remaining = max(0, cal_goal)
+        protein_remaining = max(0, protein_goal)
+        cal_percent = protein_percent = 0.0
+        status, emoji = _ADVICE_STATUS[0]
     else:
-        status = "in_progress"
-        emoji = "🟢"
+        cal_remaining = max(0, cal_goal - cal_consumed)
+        cal_percent = (cal_consumed / cal_goal * 100) if cal_goal > 0 else 0
+        
+        protein_remaining = max(0, protein_goal - protein_consumed)
+        protein_percent = (protein_consumed / protein_goal * 100) if protein_goal > 0 else 0
+        
+        # Определяем статус: индекс = сколько порогов (80%, 100%) превышено
+        status, emoji = _ADVICE_STATUS[(cal_percent > 80) + (cal_percent > 100)]
+    
+    # Время берём один раз — и для ответа, и для инструкции
+    current_time = _now().strftime(_TIME_FORMAT)
     
     return {
         "status": "success",
@@ -156,20 +209,17 @@ def get_nutrition_advice(
         },
         "status_emoji": emoji,
         "overall_status": status,
-        "goal_type": goals.get("goal_type", "maintenance"),
-        "current_time": datetime.now().strftime("%H:%M"),
-        "instruction": f"""
-        На основе прогресса пользователя дай краткую рекомендацию:
-        
-        - Прогресс по калориям: {cal_percent:.0f}% ({cal_consumed:.0f}/{cal_goal})
-        - Осталось калорий: {cal_remaining:.0f}
-        - Прогресс по белку: {protein_percent:.0f}% 
-        - Осталось белка: {protein_remaining:.0f}г
-        - Цель пользователя: {goals.get("goal_type", "maintenance")}
-        - Время: {datetime.now().strftime("%H:%M")}
-        
-        Дай конкретную рекомендацию что съесть дальше.
-        Будь позитивным и мотивирующим.
-        """
+        "goal_type": goal_type,
+        "current_time": current_time,
+        "instruction": _ADVICE_INSTRUCTION.format_map({
+            "cal_percent": cal_percent,
+            "cal_consumed": cal_consumed,
+            "cal_goal": cal_goal,
+            "cal_remaining": cal_remaining,
+            "protein_percent": protein_percent,
+            "protein_remaining": protein_remaining,
+            "goal_type": goal_type,
+            "current_time": current_time,
+        })
     }
 
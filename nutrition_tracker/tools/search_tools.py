@@ -6,8 +6,12 @@ Search Tools - Интеграция Google Search через отдельный
 """
 import asyncio
 import logging
+import threading
+import concurrent.futures
+from uuid import uuid4
 from typing import Optional
 
+from cachetools import TTLCache
 from google.adk.agents import Agent
 from google.adk.runners import Runner
 from google.adk.sessions import InMemorySessionService
@@ -56,6 +60,37 @@ _search_session_service: Optional[InMemorySessionService] = None
 _search_runner: Optional[Runner] = None
 
 
+# Отдельный event loop в фоновом потоке для search_agent: создаётся один раз,
+# вместо asyncio.run (новый loop и новые соединения) на каждый вызов
+_search_loop: Optional[asyncio.AbstractEventLoop] = None
+_search_loop_lock = threading.Lock()
+
+# Сколько ждём ответа search_agent, секунд
+SEARCH_TIMEOUT = 30
+
+# Кэш ответов по нормализованному запросу: одинаковые вопросы
+# ("калорийность авокадо") не гоняют поиск заново, но через час обновляются
+_search_cache: TTLCache = TTLCache(maxsize=512, ttl=3600)
+_search_cache_lock = threading.Lock()
+
+
+def _get_search_loop() -> asyncio.AbstractEventLoop:
+    """Получает или запускает фоновый event loop для search_agent"""
+    global _search_loop
+    
+    with _search_loop_lock:
+        if _search_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever,
+                name="search-loop",
+                daemon=True,
+            ).start()
+            _search_loop = loop
+    
+    return _search_loop
+
+
 def _get_search_runner() -> Runner:
     """Получает или создает Runner для search_agent"""
     global _search_session_service, _search_runner
@@ -73,19 +108,23 @@ def _get_search_runner() -> Runner:
 
 async def _run_search_async(query: str) -> str:
     """Внутренняя async функция для вызова search_agent"""
+    cache_key = " ".join(query.lower().split())
+    with _search_cache_lock:
+        cached = _search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     runner = _get_search_runner()
-    session_id = "search_session"
+    # Своя сессия на каждый запрос: параллельные поиски не перемешивают
+    # историю, а контекст search_agent не разрастается от запроса к запросу
+    session_id = f"search-{uuid4().hex}"
     
     try:
-        # Создаем сессию (или используем существующую)
-        try:
-            await _search_session_service.create_session(
-                app_name="nutrition_search",
-                user_id="system",
-                session_id=session_id
-            )
-        except Exception:
-            pass  # Сессия уже существует
+        await _search_session_service.create_session(
+            app_name="nutrition_search",
+            user_id="system",
+            session_id=session_id
+        )
         
         # Запрос к search_agent
         content = types.Content(
@@ -93,28 +132,49 @@ async def _run_search_async(query: str) -> str:
             parts=[types.Part(text=query)]
         )
         
+        # Ответ — первый текст финального события; до него запоминаем
+        # первый промежуточный текст на случай, если финального не будет
         final_response = ""
+        first_text = ""
         async for event in runner.run_async(
             session_id=session_id,
             user_id="system",
             new_message=content,
         ):
-            if event.content and event.content.parts:
-                for part in event.content.parts:
-                    if hasattr(part, 'text') and part.text:
-                        if event.is_final_response():
-                            final_response = part.text
-                        elif not final_response:
-                            final_response = part.text
+            # Генератор дочитываем до конца (runner завершает запуск сам),
+            # но после финального ответа части событий уже не разбираем
+            if final_response or not (event.content and event.content.parts):
+                continue
+            text = next((part.text for part in event.content.parts if part.text), "")
+            if event.is_final_response():
+                final_response = text
+            elif not first_text:
+                first_text = text
         
-        return final_response if final_response else "Информация не найдена"
+        final_response = final_response or first_text
+        if not final_response:
+            return "Информация не найдена"
+        
+        # Кэшируем только найденные ответы — ошибки и пустой результат повторяем
+        with _search_cache_lock:
+            _search_cache[cache_key] = final_response
+        return final_response
         
     except Exception as e:
         logger.error(f"Error in search_agent: {e}")
         return f"Ошибка поиска: {str(e)}"
+    finally:
+        try:
+            await _search_session_service.delete_session(
+                app_name="nutrition_search",
+                user_id="system",
+                session_id=session_id
+            )
+        except Exception:
+            pass  # Сессия не успела создаться
 
 
-def search_nutrition_info(query: str) -> dict:
+async def search_nutrition_info(query: str) -> dict:
     """
     Ищет информацию о калорийности и КБЖУ продуктов в интернете.
     
@@ -131,17 +191,10 @@ def search_nutrition_info(query: str) -> dict:
         dict со статусом и найденной информацией
     """
     try:
-        # Запускаем async функцию в event loop
-        try:
-            loop = asyncio.get_running_loop()
-            # Если уже есть running loop - создаем task
-            import concurrent.futures
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(asyncio.run, _run_search_async(query))
-                result = future.result(timeout=30)
-        except RuntimeError:
-            # Нет running loop - запускаем напрямую
-            result = asyncio.run(_run_search_async(query))
+        # Поиск выполняется в фоновом loop; ждём результат, не занимая поток.
+        # По таймауту wait_for отменяет и задачу в фоновом loop
+        future = asyncio.run_coroutine_threadsafe(_run_search_async(query), _get_search_loop())
+        result = await asyncio.wait_for(asyncio.wrap_future(future), SEARCH_TIMEOUT)
         
         return {
             "status": "success",
@@ -157,3 +210,47 @@ def search_nutrition_info(query: str) -> dict:
             "error": str(e)
         }
 
+
+def search_nutrition_info_batch(queries: list[str]) -> dict:
+    """
+    Ищет калорийность и КБЖУ сразу для нескольких продуктов параллельно.
+    
+    Используй вместо нескольких вызовов search_nutrition_info, когда
+    нужно уточнить несколько продуктов одного приема пищи.
+    
+    Args:
+        queries: Список поисковых запросов
+                 (например: ["калорийность авокадо на 100г", "калорийность тоста на 100г"])
+    
+    Returns:
+        dict со статусом и результатом по каждому запросу
+    """
+    try:
+        # Запросы идут одновременно: общее время ≈ самый долгий поиск, а не сумма
+        future = asyncio.run_coroutine_threadsafe(_run_many(queries), _get_search_loop())
+        try:
+            results = future.result(timeout=SEARCH_TIMEOUT * 2)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+        
+        return {
+            "status": "success",
+            "results": [
+                {"query": query, "result": result}
+                for query, result in zip(queries, results)
+            ]
+        }
+        
+    except Exception as e:
+        logger.error(f"Batch search error: {e}")
+        return {
+            "status": "error",
+            "queries": queries,
+            "error": str(e)
+        }
+
+
+async def _run_many(queries: list[str]) -> list[str]:
+    """Запускает несколько поисков search_agent одновременно"""
+    return await asyncio.gather(*(_run_search_async(query) for query in queries))
@@ -3,16 +3,41 @@ Tools для работы с Google Sheets.
 Эти функции используются агентами как инструменты (tools).
 """
 import os
-from datetime import datetime, timedelta
+import re
+import json
+import time
+import threading
+from contextlib import closing
+from datetime import date as _date, datetime, timedelta
 from typing import Optional
-import gspread
-from google.oauth2.service_account import Credentials
+from cachetools import TTLCache
 
 
 # Глобальные переменные для кеширования подключения
 _client = None
 _spreadsheet = None
 
+# Кэш целей пользователей: читаются на каждом ходу агента, меняются редко.
+# Сбрасывается в update_user_goals
+_goals_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+_goals_lock = threading.Lock()
+
+# Индекс user_id -> номер строки листа users: вместо sheet.find (скачивает
+# весь лист) на каждый запрос целей. Строится по столбцу A, живёт USER_ROWS_TTL секунд
+USER_ROWS_TTL = 300
+_user_rows: Optional[dict] = None
+_user_rows_expires = 0.0
+_user_rows_lock = threading.Lock()
+
+# Объекты листов: spreadsheet.worksheet() — это HTTP-запрос метаданных,
+# а листы почти не меняются. Через 5 минут перечитываем (лист могли удалить)
+_sheet_cache: TTLCache = TTLCache(maxsize=16, ttl=300)
+_sheet_cache_lock = threading.Lock()
+
+# Последний ID в листе meals: читается один раз, дальше считается локально
+_last_meal_id: Optional[int] = None
+_meal_id_lock = threading.Lock()
+
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
     'https://www.googleapis.com/auth/drive'
@@ -34,26 +59,195 @@ def _get_spreadsheet():
         if not spreadsheet_id:
             raise ValueError("SPREADSHEET_ID не задан в переменных окружения")
         
+        # gspread и google.auth импортируются при первом обращении к Sheets:
+        # модуль подгружается вместе с пакетом tools, а Sheets нужен только синхронизации
+        import gspread
+        from google.oauth2.service_account import Credentials
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        
         creds = Credentials.from_service_account_file(creds_file, scopes=SCOPES)
         _client = gspread.authorize(creds)
+        # Пул keep-alive соединений и повторы при 429/5xx. Повторяются только
+        # идемпотентные методы (GET/PUT): POST append мог бы задвоить строки
+        _client.http_client.session.mount('https://', HTTPAdapter(
+            pool_connections=20,
+            pool_maxsize=20,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+            ),
+        ))
         _spreadsheet = _client.open_by_key(spreadsheet_id)
     
     return _spreadsheet
 
 
+# Google Visualization API: язык запросов QUERY выполняется на стороне Google
+GVIZ_URL = "https://docs.google.com/spreadsheets/d/{spreadsheet_id}/gviz/tq"
+
+
+def _gviz_literal(value) -> str:
+    """
+    Строковый литерал для запроса QUERY.
+
+    Экранирования кавычек в языке нет: значение с обоими видами кавычек
+    не записать литералом, не переписав запрос, — такие значения отклоняем.
+    """
+    value = str(value)
+    if "'" in value and '"' in value:
+        raise ValueError(f"Значение нельзя подставить в запрос QUERY: {value!r}")
+    return f'"{value}"' if "'" in value else f"'{value}'"
+
+
+def _query_sheet(name: str, query: str) -> list:
+    """
+    Выполняет запрос QUERY к листу на стороне Google: по сети приходят
+    только подходящие строки, а не весь лист.
+    
+    Args:
+        name: Название листа
+        query: Запрос на языке Google Visualization (select ... where ...)
+    
+    Returns:
+        list: Строки результата — значения ячеек (None для пустых),
+              числа приходят как float
+    """
+    spreadsheet = _get_spreadsheet()
+    response = _client.http_client.session.get(
+        GVIZ_URL.format(spreadsheet_id=spreadsheet.id),
+        params={"sheet": name, "headers": 1, "tqx": "out:json", "tq": query},
+        timeout=30,
+    )
+    response.raise_for_status()
+    
+    # Ответ обёрнут в JSONP: google.visualization.Query.setResponse({...});
+    text = response.text
+    payload = json.loads(text[text.index("(") + 1:text.rindex(")")])
+    if payload.get("status") == "error":
+        errors = payload.get("errors") or [{}]
+        raise ValueError(errors[0].get("detailed_message") or errors[0].get("message") or "QUERY error")
+    
+    return [
+        [cell["v"] if cell else None for cell in row["c"]]
+        for row in payload["table"]["rows"]
+    ]
+
+
+def _append_row(sheet, row: list) -> dict:
+    """
+    Дописывает строку в конец листа.
+    table_range='A1' и INSERT_ROWS: сервер не ищет границу таблицы по всему листу,
+    а вставляет новую строку после данных; RAW — значения уже типизированы,
+    разбор как при ручном вводе не нужен.
+    """
+    return sheet.append_row(
+        row,
+        value_input_option='RAW',
+        insert_data_option='INSERT_ROWS',
+        table_range='A1',
+    )
+
+
 def _get_or_create_sheet(name: str, headers: list):
     """Получает или создает лист с заголовками"""
+    with _sheet_cache_lock:
+        sheet = _sheet_cache.get(name)
+    if sheet is not None:
+        return sheet
+    
     spreadsheet = _get_spreadsheet()
+    # gspread уже загружен в _get_spreadsheet
+    from gspread import WorksheetNotFound
     
     try:
         sheet = spreadsheet.worksheet(name)
-    except gspread.WorksheetNotFound:
+    except WorksheetNotFound:
         sheet = spreadsheet.add_worksheet(title=name, rows=1000, cols=20)
-        sheet.append_row(headers)
+        _append_row(sheet, headers)
     
+    with _sheet_cache_lock:
+        _sheet_cache[name] = sheet
     return sheet
 
 
+def _find_user_row(sheet, user_id: str) -> Optional[int]:
+    """Возвращает номер строки пользователя в листе users (None — пользователя нет)"""
+    global _user_rows, _user_rows_expires
+    
+    with _user_rows_lock:
+        if _user_rows is None or time.monotonic() >= _user_rows_expires:
+            column = sheet.col_values(1)
+            # Первая строка — заголовки
+            _user_rows = {uid: row_num for row_num, uid in enumerate(column[1:], start=2) if uid}
+            _user_rows_expires = time.monotonic() + USER_ROWS_TTL
+        return _user_rows.get(str(user_id))
+
+
+def _get_user_row(sheet, user_id: str) -> tuple:
+    """
+    Находит пользователя в листе users через индекс строк.
+    Строку сверяем с user_id: если лист правили вручную и индекс устарел,
+    перестраиваем его один раз.
+    
+    Returns:
+        tuple: (номер строки, значения строки) или (None, []) если пользователя нет
+    """
+    for _ in range(2):
+        row_num = _find_user_row(sheet, user_id)
+        if row_num is None:
+            return None, []
+        row = sheet.row_values(row_num)
+        if row and row[0] == str(user_id):
+            return row_num, row
+        with _user_rows_lock:
+            _invalidate_user_rows()
+    return None, []
+
+
+def _append_user_row(sheet, row: list):
+    """Добавляет пользователя в лист users и запоминает его строку в индексе"""
+    response = _append_row(sheet, row)
+    
+    # Номер строки берём из ответа API: "updatedRange": "users!A5:I5"
+    updated_range = (response or {}).get("updates", {}).get("updatedRange", "")
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    with _user_rows_lock:
+        if match and _user_rows is not None:
+            _user_rows[str(row[0])] = int(match.group(1))
+        else:
+            _invalidate_user_rows()
+
+
+def _invalidate_user_rows():
+    """Сбрасывает индекс строк пользователей. Вызывать под _user_rows_lock"""
+    global _user_rows
+    _user_rows = None
+
+
+def _next_meal_id(sheet) -> int:
+    """
+    Выдаёт следующий ID приёма пищи. Столбец ID читается только при первом
+    вызове (или после сброса), а не весь лист на каждую запись.
+    """
+    global _last_meal_id
+    
+    with _meal_id_lock:
+        if _last_meal_id is None:
+            column = sheet.col_values(1)
+            _last_meal_id = max((int(v) for v in column[1:] if v.isdigit()), default=0)
+        _last_meal_id += 1
+        return _last_meal_id
+
+
+def _reset_meal_id():
+    """Сбрасывает счётчик ID: следующий save_meal перечитает столбец ID"""
+    global _last_meal_id
+    with _meal_id_lock:
+        _last_meal_id = None
+
+
 def save_meal(
     user_id: str,
     description: str,
@@ -86,22 +280,15 @@ def save_meal(
             'description', 'calories', 'protein', 'fat', 'carbs', 'source'
         ])
         
-        # Получаем последний ID
-        all_values = sheet.get_all_values()
-        last_id = 0
-        if len(all_values) > 1:
-            for row in all_values[1:]:
-                if row[0].isdigit():
-                    last_id = max(last_id, int(row[0]))
-        
-        new_id = last_id + 1
-        now = datetime.now()
+        new_id = _next_meal_id(sheet)
+        # Дата и время срезами ISO-строки (YYYY-MM-DDTHH:MM) — без strftime
+        now_iso = datetime.now().isoformat(timespec='minutes')
         
         row = [
             new_id,
             user_id,
-            now.strftime('%Y-%m-%d'),
-            now.strftime('%H:%M'),
+            now_iso[:10],
+            now_iso[11:],
             meal_type,
             description,
             round(calories, 1),
@@ -111,7 +298,7 @@ def save_meal(
             source
         ]
         
-        sheet.append_row(row)
+        _append_row(sheet, row)
         
         return {
             "status": "success",
@@ -142,7 +329,7 @@ def get_today_meals(user_id: str) -> dict:
     Returns:
         dict: Список приемов пищи и суммарные показатели
     """
-    today = datetime.now().strftime('%Y-%m-%d')
+    today = _date.today().isoformat()
     return get_meals_by_date(user_id, today)
 
 
@@ -158,6 +345,9 @@ def get_meals_by_date(user_id: str, date: str) -> dict:
         dict: Список приемов пищи и статистика
     """
     try:
+        # Дата приходит от агента и попадает в запрос — сначала проверяем формат
+        date = _date.fromisoformat(date).isoformat()
+
         sheet = _get_or_create_sheet('meals', [
             'id', 'user_id', 'date', 'time', 'meal_type',
             'description', 'calories', 'protein', 'fat', 'carbs', 'source'
@@ -166,24 +356,28 @@ def get_meals_by_date(user_id: str, date: str) -> dict:
         meals = []
         totals = {"calories": 0, "protein": 0, "fat": 0, "carbs": 0}
         
-        all_values = sheet.get_all_values()
-        for row in all_values[1:]:
-            if len(row) >= 11 and str(row[1]) == str(user_id) and row[2] == date:
-                meal = {
-                    "id": row[0],
-                    "time": row[3],
-                    "meal_type": row[4],
-                    "description": row[5],
-                    "calories": float(row[6]) if row[6] else 0,
-                    "protein": float(row[7]) if row[7] else 0,
-                    "fat": float(row[8]) if row[8] else 0,
-                    "carbs": float(row[9]) if row[9] else 0,
-                }
-                meals.append(meal)
-                totals["calories"] += meal["calories"]
-                totals["protein"] += meal["protein"]
-                totals["fat"] += meal["fat"]
-                totals["carbs"] += meal["carbs"]
+        # Фильтр по пользователю и дате выполняет Google — приходят только нужные строки
+        rows = _query_sheet(
+            sheet.title,
+            f"select A, D, E, F, G, H, I, J "
+            f"where B = {_gviz_literal(user_id)} and C = {_gviz_literal(date)}"
+        )
+        for row in rows:
+            meal = {
+                "id": str(int(row[0])) if row[0] is not None else "",
+                "time": row[1] or "",
+                "meal_type": row[2] or "",
+                "description": row[3] or "",
+                "calories": float(row[4]) if row[4] else 0,
+                "protein": float(row[5]) if row[5] else 0,
+                "fat": float(row[6]) if row[6] else 0,
+                "carbs": float(row[7]) if row[7] else 0,
+            }
+            meals.append(meal)
+            totals["calories"] += meal["calories"]
+            totals["protein"] += meal["protein"]
+            totals["fat"] += meal["fat"]
+            totals["carbs"] += meal["carbs"]
         
         return {
             "status": "success",
@@ -220,28 +414,30 @@ def get_week_meals(user_id: str) -> dict:
             'description', 'calories', 'protein', 'fat', 'carbs', 'source'
         ])
         
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=7)
-        start_str = start_date.strftime('%Y-%m-%d')
-        end_str = end_date.strftime('%Y-%m-%d')
+        end_date = _date.today()
+        start_str = (end_date - timedelta(days=7)).isoformat()
+        end_str = end_date.isoformat()
         
         # Группируем по дням
         daily_stats = {}
         
-        all_values = sheet.get_all_values()
-        for row in all_values[1:]:
-            if len(row) >= 11 and str(row[1]) == str(user_id):
-                if start_str <= row[2] <= end_str:
-                    date = row[2]
-                    if date not in daily_stats:
-                        daily_stats[date] = {
-                            "calories": 0, "protein": 0, "fat": 0, "carbs": 0, "meals_count": 0
-                        }
-                    daily_stats[date]["calories"] += float(row[6]) if row[6] else 0
-                    daily_stats[date]["protein"] += float(row[7]) if row[7] else 0
-                    daily_stats[date]["fat"] += float(row[8]) if row[8] else 0
-                    daily_stats[date]["carbs"] += float(row[9]) if row[9] else 0
-                    daily_stats[date]["meals_count"] += 1
+        # Фильтр по пользователю и диапазону дат и суммы по дням считает Google:
+        # приходит по строке на день, а не весь лист
+        rows = _query_sheet(
+            sheet.title,
+            f"select C, sum(G), sum(H), sum(I), sum(J), count(A) "
+            f"where B = {_gviz_literal(user_id)} "
+            f"and C >= {_gviz_literal(start_str)} and C <= {_gviz_literal(end_str)} "
+            f"group by C"
+        )
+        for date, calories, protein, fat, carbs, meals_count in rows:
+            daily_stats[date] = {
+                "calories": calories or 0,
+                "protein": protein or 0,
+                "fat": fat or 0,
+                "carbs": carbs or 0,
+                "meals_count": int(meals_count or 0)
+            }
         
         # Округляем значения
         for date in daily_stats:
@@ -283,6 +479,22 @@ def get_user_goals(user_id: str) -> dict:
     Returns:
         dict: Цели пользователя (калории, БЖУ)
     """
+    with _goals_lock:
+        cached = _goals_cache.get(user_id)
+    if cached is not None:
+        return {"status": "success", "user_id": user_id, "goals": dict(cached)}
+    
+    result = _load_user_goals(user_id)
+    if result["status"] == "success":
+        # Кэшируем только копию целей: без разовой пометки "note" и без
+        # общих с вызывающим кодом объектов
+        with _goals_lock:
+            _goals_cache[user_id] = dict(result["goals"])
+    return result
+
+
+def _load_user_goals(user_id: str) -> dict:
+    """Читает цели пользователя из листа users (без кэша)"""
     try:
         sheet = _get_or_create_sheet('users', [
             'user_id', 'name', 'goal_type', 'daily_calories',
@@ -299,27 +511,23 @@ def get_user_goals(user_id: str) -> dict:
             "daily_carbs": 200
         }
         
-        try:
-            cell = sheet.find(str(user_id))
-            if cell:
-                row = sheet.row_values(cell.row)
-                return {
-                    "status": "success",
-                    "user_id": user_id,
-                    "goals": {
-                        "goal_type": row[2] if len(row) > 2 else default_goals["goal_type"],
-                        "daily_calories": int(row[3]) if len(row) > 3 and row[3] else default_goals["daily_calories"],
-                        "daily_protein": int(row[4]) if len(row) > 4 and row[4] else default_goals["daily_protein"],
-                        "daily_fat": int(row[5]) if len(row) > 5 and row[5] else default_goals["daily_fat"],
-                        "daily_carbs": int(row[6]) if len(row) > 6 and row[6] else default_goals["daily_carbs"]
-                    }
+        row_num, row = _get_user_row(sheet, user_id)
+        if row_num:
+            return {
+                "status": "success",
+                "user_id": user_id,
+                "goals": {
+                    "goal_type": row[2] if len(row) > 2 else default_goals["goal_type"],
+                    "daily_calories": int(row[3]) if len(row) > 3 and row[3] else default_goals["daily_calories"],
+                    "daily_protein": int(row[4]) if len(row) > 4 and row[4] else default_goals["daily_protein"],
+                    "daily_fat": int(row[5]) if len(row) > 5 and row[5] else default_goals["daily_fat"],
+                    "daily_carbs": int(row[6]) if len(row) > 6 and row[6] else default_goals["daily_carbs"]
                 }
-        except gspread.exceptions.CellNotFound:
-            pass
+            }
         
         # Создаем нового пользователя с дефолтными целями
         now = datetime.now().isoformat()
-        sheet.append_row([
+        _append_user_row(sheet, [
             user_id, "User", default_goals["goal_type"],
             default_goals["daily_calories"], default_goals["daily_protein"],
             default_goals["daily_fat"], default_goals["daily_carbs"],
@@ -361,6 +569,25 @@ def update_user_goals(
     Returns:
         dict: Статус операции и обновленные цели
     """
+    try:
+        return _write_user_goals(
+            user_id, goal_type, daily_calories, daily_protein, daily_fat, daily_carbs
+        )
+    finally:
+        # Цели изменились — следующий get_user_goals перечитает лист
+        with _goals_lock:
+            _goals_cache.pop(user_id, None)
+
+
+def _write_user_goals(
+    user_id: str,
+    goal_type: Optional[str],
+    daily_calories: Optional[int],
+    daily_protein: Optional[int],
+    daily_fat: Optional[int],
+    daily_carbs: Optional[int]
+) -> dict:
+    """Записывает цели пользователя в лист users"""
     try:
         sheet = _get_or_create_sheet('users', [
             'user_id', 'name', 'goal_type', 'daily_calories',
@@ -368,13 +595,12 @@ def update_user_goals(
             'created_at', 'updated_at'
         ])
         
-        try:
-            cell = sheet.find(str(user_id))
-            row_num = cell.row
-        except gspread.exceptions.CellNotFound:
+        # Строку сверяем с user_id — по устаревшему индексу нельзя писать в чужую строку
+        row_num, row = _get_user_row(sheet, user_id)
+        if row_num is None:
             # Создаем нового пользователя
             now = datetime.now().isoformat()
-            sheet.append_row([
+            _append_user_row(sheet, [
                 user_id, "User", goal_type or "maintenance",
                 daily_calories or 2000, daily_protein or 150,
                 daily_fat or 70, daily_carbs or 200,
@@ -385,19 +611,28 @@ def update_user_goals(
                 "message": "Создан новый пользователь с указанными целями"
             }
         
-        # Обновляем существующего пользователя
-        if goal_type:
-            sheet.update_cell(row_num, 3, goal_type)
-        if daily_calories:
-            sheet.update_cell(row_num, 4, daily_calories)
-        if daily_protein:
-            sheet.update_cell(row_num, 5, daily_protein)
-        if daily_fat:
-            sheet.update_cell(row_num, 6, daily_fat)
-        if daily_carbs:
-            sheet.update_cell(row_num, 7, daily_carbs)
-        
-        sheet.update_cell(row_num, 9, datetime.now().isoformat())
+        # Обновляем существующего пользователя: строка целиком (goal_type..updated_at)
+        # одним PUT values.update, сколько бы полей ни изменилось
+        row += [''] * (9 - len(row))
+        # Числа из листа приходят строками — возвращаем им тип, иначе RAW запишет текст
+        for col in range(3, 7):
+            if row[col].isdigit():
+                row[col] = int(row[col])
+        for col, value in (
+            (2, goal_type),
+            (3, daily_calories),
+            (4, daily_protein),
+            (5, daily_fat),
+            (6, daily_carbs),
+        ):
+            if value:
+                row[col] = value
+        row[8] = datetime.now().isoformat()
+        sheet.update(
+            range_name=f'C{row_num}:I{row_num}',
+            values=[row[2:9]],
+            value_input_option='RAW',
+        )
         
         return {
             "status": "success",
@@ -433,14 +668,19 @@ def delete_last_meal(user_id: str) -> dict:
             'description', 'calories', 'protein', 'fat', 'carbs', 'source'
         ])
         
-        all_values = sheet.get_all_values()
+        # Нужны только user_id (B) и описание (F) — два столбца одним запросом,
+        # а не весь лист
+        user_ids, descriptions = sheet.batch_get(['B:B', 'F:F'])
         last_row = None
         last_meal_desc = None
         
-        for i, row in enumerate(all_values[1:], start=2):
-            if len(row) >= 2 and str(row[1]) == str(user_id):
-                last_row = i
-                last_meal_desc = row[5] if len(row) > 5 else "Неизвестно"
+        # Ищем с конца: последняя запись пользователя — ближайшая к концу листа
+        for i in range(len(user_ids) - 1, 0, -1):
+            if user_ids[i] and str(user_ids[i][0]) == str(user_id):
+                last_row = i + 1
+                description = descriptions[i] if i < len(descriptions) else []
+                last_meal_desc = description[0] if description else "Неизвестно"
+                break
         
         if last_row:
             sheet.delete_rows(last_row)
@@ -460,10 +700,141 @@ def delete_last_meal(user_id: str) -> dict:
         }
 
 
-def sync_from_sqlite() -> dict:
+# Листы, которые переносит sync_from_sqlite: название -> заголовки
+SYNC_SHEETS = {
+    'meals': [
+        'id', 'user_id', 'date', 'time', 'meal_type',
+        'description', 'calories', 'protein', 'fat', 'carbs', 'source'
+    ],
+    'users': [
+        'user_id', 'name', 'goal_type', 'daily_calories',
+        'daily_protein', 'daily_fat', 'daily_carbs',
+        'created_at', 'updated_at'
+    ],
+    'weight_log': [
+        'id', 'user_id', 'date', 'time', 'weight', 'note', 'created_at'
+    ],
+    'memory_bank': [
+        'id', 'user_id', 'memory_type', 'content', 'metadata',
+        'created_at', 'updated_at'
+    ],
+}
+
+
+def _get_or_create_sheets(headers_by_name: dict) -> dict:
+    """Получает несколько листов одним запросом метаданных, недостающие создаёт"""
+    spreadsheet = _get_spreadsheet()
+    sheets = {sheet.title: sheet for sheet in spreadsheet.worksheets()}
+    
+    for name, headers in headers_by_name.items():
+        if name not in sheets:
+            sheet = spreadsheet.add_worksheet(title=name, rows=1000, cols=20)
+            _append_row(sheet, headers)
+            sheets[name] = sheet
+    
+    # Свежие метаданные — заодно обновляем кэш листов
+    with _sheet_cache_lock:
+        for name in headers_by_name:
+            _sheet_cache[name] = sheets[name]
+    return sheets
+
+
+# Запросы синхронизации: только нужные столбцы в порядке заголовков SYNC_SHEETS,
+# строки уходят в Sheets как есть. Читаются только строки новее контрольной точки
+# (id > ?); ORDER BY id — обход по rowid без сортировки
+SYNC_SELECT_MEALS = """
+    SELECT id, user_id, date, time, meal_type, description,
+           calories, protein, fat, carbs, source
+    FROM meals WHERE id > ? ORDER BY id
+"""
+# У users нет числового id — контрольная точка по rowid, он идёт первым столбцом
+SYNC_SELECT_USERS = """
+    SELECT rowid, user_id, name, goal_type, daily_calories, daily_protein,
+           daily_fat, daily_carbs, created_at, updated_at
+    FROM users WHERE rowid > ? ORDER BY rowid
+"""
+SYNC_SELECT_WEIGHT_LOG = """
+    SELECT id, user_id, date, time, weight, IFNULL(note, ''), created_at
+    FROM weight_log WHERE id > ? ORDER BY id
+"""
+SYNC_SELECT_MEMORY_BANK = """
+    SELECT id, user_id, memory_type, content, IFNULL(metadata, ''),
+           created_at, updated_at
+    FROM memory_bank WHERE id > ? ORDER BY id
+"""
+
+# Контрольные точки синхронизации: последний перенесённый id каждой таблицы
+SYNC_STATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS sync_state (
+        table_name TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    )
+"""
+SYNC_MAX_IDS = """
+    SELECT (SELECT MAX(id) FROM meals),
+           (SELECT MAX(rowid) FROM users),
+           (SELECT MAX(id) FROM weight_log),
+           (SELECT MAX(id) FROM memory_bank)
+"""
+
+# Сколько новых строк копим в памяти перед записью в Sheets
+SYNC_CHUNK_ROWS = 1000
+
+
+def _write_new_rows(sheets: dict, next_rows: dict, grid_rows: dict, new_rows: dict):
+    """
+    Дописывает строки в конец нескольких листов одним запросом values.batchUpdate.
+    
+    Args:
+        sheets: Листы по названию
+        next_rows: Первая свободная строка каждого листа — сдвигается после записи
+        grid_rows: Текущее число строк сетки листа — растёт, если строк не хватило
+                   (сетка расширяется одним batchUpdate перед записью)
+        new_rows: Строки для записи по названию листа — очищаются после записи
+    """
+    spreadsheet = _get_spreadsheet()
+    data = []
+    grow_requests = []
+    
+    for name, rows in new_rows.items():
+        if not rows:
+            continue
+        
+        start_row = next_rows[name]
+        end_row = start_row + len(rows) - 1
+        if end_row > grid_rows[name]:
+            grow_requests.append({
+                "appendDimension": {
+                    "sheetId": sheets[name].id,
+                    "dimension": "ROWS",
+                    "length": end_row - grid_rows[name]
+                }
+            })
+            grid_rows[name] = end_row
+        data.append({"range": f"{name}!A{start_row}", "values": list(rows)})
+        next_rows[name] = end_row + 1
+    
+    if grow_requests:
+        spreadsheet.batch_update({"requests": grow_requests})
+    if data:
+        spreadsheet.values_batch_update({"valueInputOption": "RAW", "data": data})
+    
+    for rows in new_rows.values():
+        rows.clear()
+
+
+def sync_from_sqlite(full: bool = False) -> dict:
     """
     Синхронизирует записи из SQLite в Google Sheets.
-    Переносит только те записи, которых ещё нет в Sheets.
+    Последний перенесённый id каждой таблицы хранится в sync_state:
+    переносятся только строки новее контрольной точки (и которых ещё нет в Sheets),
+    а если новых нет — Sheets не запрашивается. Строки до контрольной точки
+    повторно не выгружаются, даже если их удалили из таблицы или сменился
+    SPREADSHEET_ID, — для этого нужен full=True.
+
+    Args:
+        full: Игнорировать контрольные точки и сверить все строки заново
+              (уже записанные в Sheets ID по-прежнему пропускаются)
     
     Returns:
         dict: Статус операции со счётчиками
@@ -473,148 +844,111 @@ def sync_from_sqlite() -> dict:
     DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'nutrition.db')
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        stats = {"meals": 0, "users": 0, "weight_log": 0, "memory_bank": 0}
-        
-        # 1. Синхронизация meals
-        sheet = _get_or_create_sheet('meals', [
-            'id', 'user_id', 'date', 'time', 'meal_type',
-            'description', 'calories', 'protein', 'fat', 'carbs', 'source'
-        ])
-        
-        # Получаем существующие ID из Sheets
-        existing_data = sheet.get_all_values()
-        existing_ids = set()
-        if len(existing_data) > 1:
-            for row in existing_data[1:]:
-                if row[0] and row[0].isdigit():
-                    existing_ids.add(int(row[0]))
-        
-        # Получаем все записи из SQLite
-        cursor.execute('SELECT * FROM meals ORDER BY id')
-        meals = cursor.fetchall()
-        
-        new_rows = []
-        for m in meals:
-            if m['id'] not in existing_ids:
-                new_rows.append([
-                    m['id'], m['user_id'], m['date'], m['time'], m['meal_type'],
-                    m['description'], m['calories'], m['protein'], m['fat'], 
-                    m['carbs'], m['source']
-                ])
-        
-        if new_rows:
-            sheet.append_rows(new_rows)
-            stats["meals"] = len(new_rows)
-        
-        # 2. Синхронизация users
-        sheet = _get_or_create_sheet('users', [
-            'user_id', 'name', 'goal_type', 'daily_calories',
-            'daily_protein', 'daily_fat', 'daily_carbs',
-            'created_at', 'updated_at'
-        ])
-        
-        existing_data = sheet.get_all_values()
-        existing_user_ids = set()
-        if len(existing_data) > 1:
-            for row in existing_data[1:]:
-                if row[0]:
-                    existing_user_ids.add(row[0])
-        
-        cursor.execute('SELECT * FROM users')
-        users = cursor.fetchall()
-        
-        new_rows = []
-        for u in users:
-            if u['user_id'] not in existing_user_ids:
-                new_rows.append([
-                    u['user_id'], u['name'], u['goal_type'], u['daily_calories'],
-                    u['daily_protein'], u['daily_fat'], u['daily_carbs'],
-                    u['created_at'], u['updated_at']
-                ])
-        
-        if new_rows:
-            sheet.append_rows(new_rows)
-            stats["users"] = len(new_rows)
-        
-        # 3. Синхронизация weight_log
-        sheet = _get_or_create_sheet('weight_log', [
-            'id', 'user_id', 'date', 'time', 'weight', 'note', 'created_at'
-        ])
-        
-        existing_data = sheet.get_all_values()
-        existing_ids = set()
-        if len(existing_data) > 1:
-            for row in existing_data[1:]:
-                if row[0] and row[0].isdigit():
-                    existing_ids.add(int(row[0]))
-        
-        cursor.execute('SELECT * FROM weight_log ORDER BY id')
-        weights = cursor.fetchall()
-        
-        new_rows = []
-        for w in weights:
-            if w['id'] not in existing_ids:
-                new_rows.append([
-                    w['id'], w['user_id'], w['date'], w['time'],
-                    w['weight'], w['note'] or '', w['created_at']
-                ])
-        
-        if new_rows:
-            sheet.append_rows(new_rows)
-            stats["weight_log"] = len(new_rows)
-        
-        # 4. Синхронизация memory_bank
-        sheet = _get_or_create_sheet('memory_bank', [
-            'id', 'user_id', 'memory_type', 'content', 'metadata',
-            'created_at', 'updated_at'
-        ])
-        
-        existing_data = sheet.get_all_values()
-        existing_ids = set()
-        if len(existing_data) > 1:
-            for row in existing_data[1:]:
-                if row[0] and row[0].isdigit():
-                    existing_ids.add(int(row[0]))
-        
-        cursor.execute('SELECT * FROM memory_bank ORDER BY id')
-        memories = cursor.fetchall()
-        
-        new_rows = []
-        for m in memories:
-            if m['id'] not in existing_ids:
-                new_rows.append([
-                    m['id'], m['user_id'], m['memory_type'], m['content'],
-                    m['metadata'] or '', m['created_at'], m['updated_at']
-                ])
-        
-        if new_rows:
-            sheet.append_rows(new_rows)
-            stats["memory_bank"] = len(new_rows)
+        # closing: соединение (и снимок WAL) освобождается и при ошибке Sheets API
+        with closing(sqlite3.connect(DB_PATH)) as conn:
+            cursor = conn.cursor()
+
+            stats = {"meals": 0, "users": 0, "weight_log": 0, "memory_bank": 0}
+
+            cursor.execute(SYNC_STATE_TABLE)
+            last_ids = dict(cursor.execute('SELECT table_name, last_id FROM sync_state'))
+            last_ids = {name: 0 if full else last_ids.get(name, 0) for name in SYNC_SHEETS}
+            max_ids = dict(zip(SYNC_SHEETS, cursor.execute(SYNC_MAX_IDS).fetchone()))
+
+            # Новых строк нет ни в одной таблице — в Sheets не ходим
+            if all((max_ids[name] or 0) <= last_ids[name] for name in SYNC_SHEETS):
+                return {
+                    "status": "success",
+                    "message": "✅ Все данные уже синхронизированы!",
+                    "stats": stats
+                }
         
-        conn.close()
+            # Все листы и их столбцы ID — двумя запросами вместо чтения каждого листа целиком
+            sheets = _get_or_create_sheets(SYNC_SHEETS)
+            value_ranges = _get_spreadsheet().values_batch_get(
+                [f"{name}!A:A" for name in SYNC_SHEETS]
+            )["valueRanges"]
+            id_columns = {
+                name: [row[0] if row else '' for row in value_range.get("values", [])]
+                for name, value_range in zip(SYNC_SHEETS, value_ranges)
+            }
+            next_rows = {name: len(column) + 1 for name, column in id_columns.items()}
+            grid_rows = {name: sheet.row_count for name, sheet in sheets.items()}
+
+            # Строки из SQLite читаем курсором и пишем пачками по SYNC_CHUNK_ROWS —
+            # память не растёт с размером таблиц
+            new_rows = {name: [] for name in SYNC_SHEETS}
+
+            def add_row(name: str, row: list):
+                new_rows[name].append(row)
+                stats[name] += 1
+                if sum(map(len, new_rows.values())) >= SYNC_CHUNK_ROWS:
+                    _write_new_rows(sheets, next_rows, grid_rows, new_rows)
+
+            # 1. Синхронизация meals
+            existing_ids = {int(v) for v in id_columns['meals'][1:] if v.isdigit()}
+
+            for meal in cursor.execute(SYNC_SELECT_MEALS, (last_ids['meals'],)):
+                if meal[0] not in existing_ids:
+                    add_row('meals', list(meal))
+
+            # 2. Синхронизация users
+            existing_user_ids = {v for v in id_columns['users'][1:] if v}
+
+            for _, *user in cursor.execute(SYNC_SELECT_USERS, (last_ids['users'],)):
+                if user[0] not in existing_user_ids:
+                    add_row('users', user)
+
+            # 3. Синхронизация weight_log
+            existing_ids = {int(v) for v in id_columns['weight_log'][1:] if v.isdigit()}
+
+            for weight in cursor.execute(SYNC_SELECT_WEIGHT_LOG, (last_ids['weight_log'],)):
+                if weight[0] not in existing_ids:
+                    add_row('weight_log', list(weight))
+
+            # 4. Синхронизация memory_bank
+            existing_ids = {int(v) for v in id_columns['memory_bank'][1:] if v.isdigit()}
+
+            for memory in cursor.execute(SYNC_SELECT_MEMORY_BANK, (last_ids['memory_bank'],)):
+                if memory[0] not in existing_ids:
+                    add_row('memory_bank', list(memory))
+
+            # Остаток — одним запросом
+            _write_new_rows(sheets, next_rows, grid_rows, new_rows)
+
+            # Контрольные точки сдвигаем только после успешной записи в Sheets
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO sync_state (table_name, last_id) VALUES (?, ?)',
+                    [(name, max_id) for name, max_id in max_ids.items() if max_id]
+                )
+            if stats['meals']:
+                # В meals записаны ID из SQLite — счётчик перечитаем при следующем save_meal
+                _reset_meal_id()
+            if stats['users']:
+                # В лист users добавились строки — индекс строк пользователей устарел
+                with _user_rows_lock:
+                    _invalidate_user_rows()
+
+            total = sum(stats.values())
+            if total == 0:
+                return {
+                    "status": "success",
+                    "message": "✅ Все данные уже синхронизированы!",
+                    "stats": stats
+                }
         
-        total = sum(stats.values())
-        if total == 0:
             return {
                 "status": "success",
-                "message": "✅ Все данные уже синхронизированы!",
+                "message": f"✅ Синхронизировано: {stats['meals']} приёмов пищи, "
+                          f"{stats['users']} пользователей, {stats['weight_log']} записей веса, "
+                          f"{stats['memory_bank']} записей памяти",
                 "stats": stats
             }
-        
-        return {
-            "status": "success",
-            "message": f"✅ Синхронизировано: {stats['meals']} приёмов пищи, "
-                      f"{stats['users']} пользователей, {stats['weight_log']} записей веса, "
-                      f"{stats['memory_bank']} записей памяти",
-            "stats": stats
-        }
-        
+
+
     except Exception as e:
         return {
             "status": "error",
             "message": f"❌ Ошибка синхронизации: {str(e)}"
-        }
\ No newline at end of file
+        }
@@ -1,79 +1,576 @@
 """
 Tools для работы с SQLite (временная замена Google Sheets).
+
+Даты хранятся текстом YYYY-MM-DD, время — HH:MM. CHECK в схеме есть только
+у баз, созданных с ним (CREATE TABLE IF NOT EXISTS не меняет старые таблицы),
+поэтому даты и время от вызывающего кода проверяются в Python (_parse_date,
+_check_time) перед записью; свои дату и время SQL ставит сам.
+В запросах столбец date сравнивается напрямую (=, BETWEEN): обёртка
+вроде strftime('%Y-%m-%d', date) отключает индекс idx_meals_user_date.
 """
 import os
+import copy
+import atexit
 import sqlite3
-from datetime import datetime, timedelta
+import queue
+import threading
+from contextlib import contextmanager
+from datetime import date as _date, datetime, timedelta
 from typing import Optional
 
+from cachetools import TTLCache
+
 # Путь к базе данных
 DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'nutrition.db')
 
-def _get_connection():
-    """Получает подключение к SQLite"""
-    conn = sqlite3.connect(DB_PATH)
+# Одно подключение на запись и небольшой пул подключений только на чтение.
+# В режиме WAL читатели не ждут писателя и друг друга, а записи всё равно
+# идут по одной — поэтому писатель один и доступ к нему сериализуется локом
+READER_POOL_SIZE = 4
+
+_writer: Optional[sqlite3.Connection] = None
+_writer_lock = threading.RLock()
+
+_readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=READER_POOL_SIZE)
+_readers_opened = 0
+_readers_lock = threading.Lock()
+
+# Кэш целей пользователя: get_user_goals вызывается почти на каждом ходу агента,
+# а цели меняются редко. Ключ — user_id, сбрасывается в update_user_goals.
+# TTLCache не потокобезопасен — обращения под локом
+_goals_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+_goals_cache_lock = threading.Lock()
+# user_id -> номер сброса кэша целей: результат чтения, начатого до сброса, не кэшируется
+_goals_generation: dict[str, int] = {}
+
+# Кэш get_weight_history: в течение дня история меняется только через
+# save_weight/delete_weight, которые сбрасывают записи пользователя.
+# Ключ — (user_id, days, сегодняшняя дата)
+_history_cache: TTLCache = TTLCache(maxsize=1024, ttl=600)
+_history_cache_lock = threading.Lock()
+# user_id -> номер сброса кэша истории. Чтение, начатое до сброса, могло увидеть
+# старые данные — такой результат в кэш не кладём
+_history_generation: dict[str, int] = {}
+
+
+def _normalize_description(text: str) -> str:
+    """Описание для сравнения дублей: без регистра и крайних пробелов.
+    Встроенный lower() SQLite меняет регистр только у ASCII, а описания на русском"""
+    return text.lower().strip() if text else text
+
+
+def _parse_date(value: str) -> _date:
+    """Разбирает дату строго в формате YYYY-MM-DD (fromisoformat принимает и YYYYMMDD)"""
+    parsed = _date.fromisoformat(value)
+    if parsed.isoformat() != value:
+        raise ValueError(f"Дата должна быть в формате YYYY-MM-DD: {value!r}")
+    return parsed
+
+
+def _check_time(value: str) -> str:
+    """Проверяет, что время задано строго как HH:MM"""
+    if not isinstance(value, str) or len(value) != 5:
+        raise ValueError(f"Время должно быть в формате HH:MM: {value!r}")
+    datetime.strptime(value, "%H:%M")
+    return value
+
+
+def _open_connection(read_only: bool = False) -> sqlite3.Connection:
+    """Открывает подключение к SQLite с общими настройками"""
+    # check_same_thread=False — подключения переходят между потоками пула
+    # (asyncio.to_thread) и закрываются atexit из главного потока.
+    # cached_statements: подготовленные запросы (SQL_* ниже) переиспользуются,
+    # пока подключение живо, — без повторного разбора и планирования.
+    # timeout — busy_timeout: в файл пишут и другие подключения (memory_tools,
+    # синхронизация с Sheets), вместо "database is locked" ждём до 30 с
+    conn = sqlite3.connect(
+        DB_PATH, timeout=30, check_same_thread=False, cached_statements=256
+    )
     conn.row_factory = sqlite3.Row
+    conn.create_function(
+        "normalize_description", 1, _normalize_description, deterministic=True
+    )
+    # Настройки подключения (journal_mode=WAL хранится в файле БД — см. _init_db)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=134217728")
+    if read_only:
+        # Случайная запись через читателя завершится ошибкой, а не займёт блокировку
+        conn.execute("PRAGMA query_only=1")
+    else:
+        # Неявные транзакции писателя — BEGIN IMMEDIATE: блокировка записи берётся
+        # сразу (ожидание — по busy_timeout), а не при первой записи посреди транзакции,
+        # где SQLITE_BUSY уже не дождаться и остаётся только откат
+        conn.isolation_level = "IMMEDIATE"
+    atexit.register(conn.close)
     return conn
 
+
+@contextmanager
+def _writer_connection():
+    """Подключение на запись; пока оно занято, другие потоки ждут на локе"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _open_connection()
+        elif _writer.in_transaction:
+            # Предыдущий вызов упал до commit — откатываем, чтобы не держать блокировку записи
+            _writer.rollback()
+        yield _writer
+
+
+@contextmanager
+def _reader_connection():
+    """Подключение только на чтение из пула; новые открываются до READER_POOL_SIZE"""
+    global _readers_opened
+    try:
+        conn = _readers.get_nowait()
+    except queue.Empty:
+        with _readers_lock:
+            can_open = _readers_opened < READER_POOL_SIZE
+            if can_open:
+                _readers_opened += 1
+        if can_open:
+            try:
+                conn = _open_connection(read_only=True)
+            except Exception:
+                # Место в пуле освобождаем — иначе после READER_POOL_SIZE неудач
+                # все дальнейшие вызовы навсегда зависнут на _readers.get()
+                with _readers_lock:
+                    _readers_opened -= 1
+                raise
+        else:
+            conn = _readers.get()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        _readers.put(conn)
+
+
+# Версия схемы в PRAGMA user_version. Увеличивать при каждом изменении
+# таблиц/индексов в _init_db — иначе существующие базы его не получат
+_SCHEMA_VERSION = 2
+
+
 def _init_db():
     """Инициализирует таблицы если их нет"""
-    conn = _get_connection()
-    cursor = conn.cursor()
-    
-    # Таблица приемов пищи
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS meals (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            date TEXT NOT NULL,
-            time TEXT NOT NULL,
-            meal_type TEXT DEFAULT 'snack',
-            description TEXT NOT NULL,
-            calories REAL DEFAULT 0,
-            protein REAL DEFAULT 0,
-            fat REAL DEFAULT 0,
-            carbs REAL DEFAULT 0,
-            source TEXT DEFAULT 'text',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Таблица пользователей и их целей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id TEXT PRIMARY KEY,
-            name TEXT DEFAULT 'User',
-            goal_type TEXT DEFAULT 'maintenance',
-            daily_calories INTEGER DEFAULT 2000,
-            daily_protein INTEGER DEFAULT 150,
-            daily_fat INTEGER DEFAULT 70,
-            daily_carbs INTEGER DEFAULT 200,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Таблица для записи веса
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS weight_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            date TEXT NOT NULL,
-            time TEXT NOT NULL,
-            weight REAL NOT NULL,
-            note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(user_id, date)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    with _writer_connection() as conn:
+        cursor = conn.cursor()
+        
+        # Схема актуальна — при импорте достаточно одного чтения PRAGMA
+        (version,) = cursor.execute("PRAGMA user_version").fetchone()
+        if version >= _SCHEMA_VERSION:
+            return
+        
+        # WAL: коммит — дозапись в журнал без fsync основного файла,
+        # читатели не блокируют писателя. Режим сохраняется в самой БД
+        conn.execute("PRAGMA journal_mode=WAL")
+        
+        # Таблица приемов пищи
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS meals (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                date TEXT NOT NULL CHECK(length(date) = 10 AND date LIKE '____-__-__'),
+                time TEXT NOT NULL CHECK(length(time) = 5),
+                meal_type TEXT DEFAULT 'snack',
+                description TEXT NOT NULL,
+                calories REAL DEFAULT 0,
+                protein REAL DEFAULT 0,
+                fat REAL DEFAULT 0,
+                carbs REAL DEFAULT 0,
+                source TEXT DEFAULT 'text',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Таблица пользователей и их целей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                name TEXT DEFAULT 'User',
+                goal_type TEXT DEFAULT 'maintenance',
+                daily_calories INTEGER DEFAULT 2000,
+                daily_protein INTEGER DEFAULT 150,
+                daily_fat INTEGER DEFAULT 70,
+                daily_carbs INTEGER DEFAULT 200,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Таблица для записи веса
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS weight_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                date TEXT NOT NULL CHECK(length(date) = 10 AND date LIKE '____-__-__'),
+                time TEXT NOT NULL CHECK(length(time) = 5),
+                weight REAL NOT NULL,
+                note TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(user_id, date)
+            )
+        ''')
+        
+        # Индексы для выборок по пользователю: за дату/период (дневник, неделя,
+        # защита от дублей) и последняя запись (edit_meal/delete_meal).
+        # weight_log(user_id, date) уже покрыт индексом ограничения UNIQUE
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_meals_user_date 
+            ON meals(user_id, date, time)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_meals_user_id_desc 
+            ON meals(user_id, id DESC)
+        ''')
+        
+        # Суммы КБЖУ по дням: сводки читают одну строку на день вместо всех
+        # приёмов пищи. Поддерживается триггерами на meals — писать в неё напрямую не нужно
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS meal_daily_totals (
+                user_id TEXT NOT NULL,
+                date TEXT NOT NULL,
+                calories REAL NOT NULL DEFAULT 0,
+                protein REAL NOT NULL DEFAULT 0,
+                fat REAL NOT NULL DEFAULT 0,
+                carbs REAL NOT NULL DEFAULT 0,
+                meals_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, date)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS meals_ai AFTER INSERT ON meals
+            BEGIN
+                INSERT INTO meal_daily_totals (user_id, date, calories, protein, fat, carbs, meals_count)
+                VALUES (NEW.user_id, NEW.date, COALESCE(NEW.calories, 0), COALESCE(NEW.protein, 0),
+                        COALESCE(NEW.fat, 0), COALESCE(NEW.carbs, 0), 1)
+                ON CONFLICT (user_id, date) DO UPDATE SET
+                    calories = calories + excluded.calories,
+                    protein = protein + excluded.protein,
+                    fat = fat + excluded.fat,
+                    carbs = carbs + excluded.carbs,
+                    meals_count = meals_count + 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS meals_ad AFTER DELETE ON meals
+            BEGIN
+                UPDATE meal_daily_totals SET
+                    calories = calories - COALESCE(OLD.calories, 0),
+                    protein = protein - COALESCE(OLD.protein, 0),
+                    fat = fat - COALESCE(OLD.fat, 0),
+                    carbs = carbs - COALESCE(OLD.carbs, 0),
+                    meals_count = meals_count - 1
+                WHERE user_id = OLD.user_id AND date = OLD.date;
+                DELETE FROM meal_daily_totals
+                WHERE user_id = OLD.user_id AND date = OLD.date AND meals_count <= 0;
+            END
+        ''')
+        # Изменение приёма = удаление старой версии + добавление новой
+        # (дата или пользователь тоже могут поменяться)
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS meals_au
+            AFTER UPDATE OF user_id, date, calories, protein, fat, carbs ON meals
+            BEGIN
+                UPDATE meal_daily_totals SET
+                    calories = calories - COALESCE(OLD.calories, 0),
+                    protein = protein - COALESCE(OLD.protein, 0),
+                    fat = fat - COALESCE(OLD.fat, 0),
+                    carbs = carbs - COALESCE(OLD.carbs, 0),
+                    meals_count = meals_count - 1
+                WHERE user_id = OLD.user_id AND date = OLD.date;
+                DELETE FROM meal_daily_totals
+                WHERE user_id = OLD.user_id AND date = OLD.date AND meals_count <= 0;
+                INSERT INTO meal_daily_totals (user_id, date, calories, protein, fat, carbs, meals_count)
+                VALUES (NEW.user_id, NEW.date, COALESCE(NEW.calories, 0), COALESCE(NEW.protein, 0),
+                        COALESCE(NEW.fat, 0), COALESCE(NEW.carbs, 0), 1)
+                ON CONFLICT (user_id, date) DO UPDATE SET
+                    calories = calories + excluded.calories,
+                    protein = protein + excluded.protein,
+                    fat = fat + excluded.fat,
+                    carbs = carbs + excluded.carbs,
+                    meals_count = meals_count + 1;
+            END
+        ''')
+        # Заполняем сводку по уже записанным приёмам (база из версии без неё)
+        cursor.execute("DELETE FROM meal_daily_totals")
+        cursor.execute('''
+            INSERT INTO meal_daily_totals (user_id, date, calories, protein, fat, carbs, meals_count)
+            SELECT user_id, date,
+                   COALESCE(SUM(calories), 0), COALESCE(SUM(protein), 0),
+                   COALESCE(SUM(fat), 0), COALESCE(SUM(carbs), 0), COUNT(*)
+            FROM meals
+            GROUP BY user_id, date
+        ''')
+        
+        cursor.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        conn.commit()
 
 # Инициализируем БД при импорте
 _init_db()
 
 
+# Запросы — константы модуля: одинаковый текст попадает в кэш подготовленных
+# запросов подключения. Горячие выборки по meals закрепляют индекс через INDEXED BY:
+# план не меняется с ростом таблицы, а без индекса запрос падает, а не сканирует таблицу
+
+# Мягкая защита от дублей: запись не вставляется, если последний приём того же
+# типа за окно времени (time >= :since) имеет то же описание
+# Дата и время записи берутся из часов SQLite (локальное время) — Python
+# передаёт только данные о еде. Столбец date по-прежнему сравнивается напрямую
+SQL_SELECT_RECENT_MEAL = '''
+    SELECT id, description FROM meals INDEXED BY idx_meals_user_date
+    WHERE user_id = :user_id AND date = date('now', 'localtime')
+      AND time >= strftime('%H:%M', 'now', 'localtime', '-2 minutes') AND meal_type = :meal_type
+    ORDER BY id DESC LIMIT 1
+'''
+SQL_INSERT_MEAL = f'''
+    INSERT INTO meals (user_id, date, time, meal_type, description, calories, protein, fat, carbs, source)
+    SELECT :user_id, date('now', 'localtime'), strftime('%H:%M', 'now', 'localtime'),
+           :meal_type, :description,
+           ROUND(:calories, 1), ROUND(:protein, 1), ROUND(:fat, 1), ROUND(:carbs, 1), :source
+    WHERE NOT EXISTS (
+        SELECT 1 FROM ({SQL_SELECT_RECENT_MEAL})
+        WHERE normalize_description(description) = :normalized_description
+    )
+'''
+SQL_SELECT_MEALS_BY_DATE = '''
+    SELECT id, time, meal_type, description,
+           ROUND(COALESCE(calories, 0), 1) as calories,
+           ROUND(COALESCE(protein, 0), 1) as protein,
+           ROUND(COALESCE(fat, 0), 1) as fat,
+           ROUND(COALESCE(carbs, 0), 1) as carbs
+    FROM meals INDEXED BY idx_meals_user_date
+    WHERE user_id = ? AND date = ?
+    ORDER BY time
+'''
+# Итоги по дням читаются из сводки meal_daily_totals (см. _init_db): одна строка
+# на день по первичному ключу, сколько бы приёмов пищи ни было записано.
+# Агрегат над пустой выборкой всё равно вернёт строку — с нулями
+SQL_SELECT_DAY_TOTALS = '''
+    SELECT ROUND(COALESCE(SUM(calories), 0), 1) as calories,
+           ROUND(COALESCE(SUM(protein), 0), 1) as protein,
+           ROUND(COALESCE(SUM(fat), 0), 1) as fat,
+           ROUND(COALESCE(SUM(carbs), 0), 1) as carbs
+    FROM meal_daily_totals
+    WHERE user_id = ? AND date = ?
+'''
+# Итоги дня и цели пользователя одним запросом (для сводки «за сегодня»).
+# Агрегат всегда даёт одну строку; для неизвестного пользователя цели будут NULL
+SQL_SELECT_DAY_TOTALS_WITH_GOALS = '''
+    SELECT t.calories, t.protein, t.fat, t.carbs,
+           u.goal_type, u.daily_calories, u.daily_protein, u.daily_fat, u.daily_carbs
+    FROM (
+        SELECT ROUND(COALESCE(SUM(calories), 0), 1) as calories,
+               ROUND(COALESCE(SUM(protein), 0), 1) as protein,
+               ROUND(COALESCE(SUM(fat), 0), 1) as fat,
+               ROUND(COALESCE(SUM(carbs), 0), 1) as carbs
+        FROM meal_daily_totals
+        WHERE user_id = :user_id AND date = :date
+    ) t
+    LEFT JOIN users u ON u.user_id = :user_id
+'''
+# Недельная статистика: суммы по дням и средние по дням за период одним запросом
+SQL_SELECT_WEEK_TOTALS = '''
+    WITH daily AS (
+        SELECT date, calories, protein, fat, carbs, meals_count
+        FROM meal_daily_totals
+        WHERE user_id = ? AND date BETWEEN ? AND ?
+    )
+    SELECT date,
+           ROUND(calories, 1) as calories,
+           ROUND(protein, 1) as protein,
+           ROUND(fat, 1) as fat,
+           ROUND(carbs, 1) as carbs,
+           meals_count,
+           (SELECT ROUND(AVG(calories), 1) FROM daily) as avg_calories,
+           (SELECT ROUND(AVG(protein), 1) FROM daily) as avg_protein
+    FROM daily
+    ORDER BY date
+'''
+# Присваивания для SET в edit_meal: КБЖУ округляются в SQL, как и при вставке
+_MEAL_SET_EXPRESSIONS = {
+    "description": "description = ?",
+    "calories": "calories = ROUND(?, 1)",
+    "protein": "protein = ROUND(?, 1)",
+    "fat": "fat = ROUND(?, 1)",
+    "carbs": "carbs = ROUND(?, 1)",
+}
+# edit_meal: SET собирается из переданных полей ({set_clause}), изменённая запись
+# сразу возвращается RETURNING — без SELECT до и после. Чужая или отсутствующая
+# запись не обновится, и RETURNING будет пуст
+SQL_UPDATE_USER_MEAL = '''
+    UPDATE meals SET {set_clause}
+    WHERE id = ? AND user_id = ?
+    RETURNING id, description, calories, protein, fat, carbs
+'''
+SQL_UPDATE_LAST_MEAL = '''
+    UPDATE meals SET {set_clause}
+    WHERE id = (SELECT id FROM meals INDEXED BY idx_meals_user_id_desc WHERE user_id = ? ORDER BY id DESC LIMIT 1)
+    RETURNING id, description, calories, protein, fat, carbs
+'''
+# Удаление сразу возвращает удалённое — без SELECT перед DELETE
+SQL_DELETE_USER_MEAL = '''
+    DELETE FROM meals WHERE id = ? AND user_id = ?
+    RETURNING id, description
+'''
+SQL_DELETE_LAST_MEAL = '''
+    DELETE FROM meals
+    WHERE id = (SELECT id FROM meals INDEXED BY idx_meals_user_id_desc WHERE user_id = ? ORDER BY id DESC LIMIT 1)
+    RETURNING id, description
+'''
+
+# Только цели — служебные name/created_at/updated_at в ответы не попадают
+SQL_SELECT_USER = '''
+    SELECT goal_type, daily_calories, daily_protein, daily_fat, daily_carbs
+    FROM users WHERE user_id = ?
+'''
+# Новый пользователь с целями по умолчанию из схемы таблицы. ON CONFLICT DO NOTHING:
+# параллельный вызов мог создать его раньше — тогда RETURNING пуст
+SQL_INSERT_DEFAULT_USER = '''
+    INSERT INTO users (user_id) VALUES (?)
+    ON CONFLICT(user_id) DO NOTHING
+    RETURNING goal_type, daily_calories, daily_protein, daily_fat, daily_carbs
+'''
+SQL_INSERT_USER = '''
+    INSERT INTO users (user_id, goal_type, daily_calories, daily_protein, daily_fat, daily_carbs)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# save_weight: дата и время записи, вес за сегодня (если уже записан) и предыдущий
+# замер — одним запросом. Дата и время берутся из часов SQLite, как у приёмов пищи.
+# Читается до UPSERT: RETURNING видит уже перезаписанную строку
+SQL_SELECT_WEIGHT_CONTEXT = '''
+    SELECT today.date, today.time,
+           (SELECT weight FROM weight_log WHERE user_id = :user_id AND date = today.date) as current_weight,
+           prev.weight as previous_weight,
+           prev.date as previous_date
+    FROM (SELECT date('now', 'localtime') as date, strftime('%H:%M', 'now', 'localtime') as time) AS today
+    LEFT JOIN (
+        SELECT weight, date FROM weight_log
+        WHERE user_id = :user_id AND date < date('now', 'localtime')
+        ORDER BY date DESC LIMIT 1
+    ) AS prev
+'''
+# Один замер в день: повторная запись за дату перезаписывает её (UNIQUE(user_id, date)).
+# Без RETURNING — для executemany в save_weights_bulk
+SQL_UPSERT_WEIGHT_ROWS = '''
+    INSERT INTO weight_log (user_id, date, time, weight, note)
+    VALUES (:user_id, :date, :time, :weight, :note)
+    ON CONFLICT (user_id, date) DO UPDATE SET
+        weight = excluded.weight,
+        time = excluded.time,
+        note = excluded.note,
+        created_at = CURRENT_TIMESTAMP
+'''
+SQL_UPSERT_WEIGHT = SQL_UPSERT_WEIGHT_ROWS + '''    RETURNING id
+'''
+SQL_SELECT_WEIGHT_HISTORY = '''
+    SELECT date, time, weight, note
+    FROM weight_log
+    WHERE user_id = :user_id AND date BETWEEN :start AND :end
+    ORDER BY date DESC
+'''
+# Статистика истории веса считается в SQLite, а не циклом по строкам
+SQL_SELECT_WEIGHT_STATS = '''
+    WITH period AS (
+        SELECT date, weight FROM weight_log
+        WHERE user_id = :user_id AND date BETWEEN :start AND :end
+    ),
+    ends AS (
+        SELECT (SELECT weight FROM period ORDER BY date DESC LIMIT 1) as current,
+               (SELECT weight FROM period ORDER BY date LIMIT 1) as first
+    )
+    SELECT ROUND(current, 1) as current_weight,
+           ROUND(first, 1) as start_weight,
+           ROUND(current - first, 2) as total_change,
+           ROUND(MIN(weight), 1) as min_weight,
+           ROUND(MAX(weight), 1) as max_weight,
+           ROUND(AVG(weight), 1) as avg_weight
+    FROM period, ends
+'''
+# Анализ веса и питания: вес и итоги питания по дням (FULL OUTER JOIN через
+# UNION дат) вместе с целью по калориям — одним запросом. Строка с целью есть
+# всегда: если за период нет данных, вернётся одна строка с date = NULL.
+# Поля ответа по дням округляет SQLite; calories без округления — для средних
+SQL_SELECT_WEIGHT_NUTRITION = '''
+    WITH w AS (
+        SELECT date, weight FROM weight_log
+        WHERE user_id = :user_id AND date BETWEEN :start AND :end
+    ),
+    n AS (
+        SELECT date, calories, protein FROM meal_daily_totals
+        WHERE user_id = :user_id AND date BETWEEN :start AND :end
+    )
+    SELECT d.date, w.weight, n.calories,
+           ROUND(n.calories, 0) as calories_rounded,
+           ROUND(n.protein, 1) as protein,
+           ROUND(u.daily_goal - n.calories, 0) as deficit_surplus,
+           u.daily_goal
+    FROM (
+        SELECT COALESCE(
+            (SELECT daily_calories FROM users WHERE user_id = :user_id), 2000
+        ) as daily_goal
+    ) AS u
+    LEFT JOIN (SELECT date FROM w UNION SELECT date FROM n) AS d
+    LEFT JOIN w ON w.date = d.date
+    LEFT JOIN n ON n.date = d.date
+    ORDER BY d.date
+'''
+# Удаление веса сразу возвращает удалённую запись — без SELECT перед DELETE
+SQL_DELETE_WEIGHT_BY_DATE = '''
+    DELETE FROM weight_log WHERE user_id = ? AND date = ?
+    RETURNING date, weight
+'''
+SQL_DELETE_LAST_WEIGHT = '''
+    DELETE FROM weight_log
+    WHERE id = (SELECT id FROM weight_log WHERE user_id = ? ORDER BY date DESC LIMIT 1)
+    RETURNING date, weight
+'''
+
+
+def _insert_meals(conn: sqlite3.Connection, user_id: str, meals: list) -> list:
+    """
+    Записывает приемы пищи одной транзакцией — общий путь save_meal и save_meals_bulk.
+    
+    Мягкая защита от дублей: ТОЧНОЕ совпадение описания (без учёта регистра)
+    за последние 2 минуты — проверяется в том же INSERT.
+    
+    Returns:
+        list: Для каждого приема пищи — (meal_id, None) если записан,
+              или (None, (id, description)) уже записанного дубля
+    """
+    cursor = conn.cursor()
+    # Нужны только id и описание дубля — обычные кортежи вместо sqlite3.Row
+    cursor.row_factory = None
+    results = []
+    # with conn: один commit на всю пачку, rollback при ошибке
+    with conn:
+        for meal in meals:
+            params = {
+                "user_id": user_id,
+                "meal_type": meal.get("meal_type", "snack"),
+                "description": meal["description"],
+                "normalized_description": _normalize_description(meal["description"]),
+                "calories": meal["calories"],
+                "protein": meal["protein"],
+                "fat": meal["fat"],
+                "carbs": meal["carbs"],
+                "source": meal.get("source", "text")
+            }
+            cursor.execute(SQL_INSERT_MEAL, params)
+            if cursor.rowcount:
+                results.append((cursor.lastrowid, None))
+            else:
+                cursor.execute(SQL_SELECT_RECENT_MEAL, params)
+                results.append((None, cursor.fetchone()))
+    return results
+
+
 def save_meal(
     user_id: str,
     description: str,
@@ -101,65 +598,75 @@ def save_meal(
         dict: Статус операции и ID записи
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        now = datetime.now()
-        
-        # Мягкая защита от дублей: проверяем ТОЧНОЕ совпадение описания за последние 2 минуты
-        two_min_ago = (now - timedelta(minutes=2)).strftime('%H:%M')
-        cursor.execute('''
-            SELECT id, description FROM meals 
-            WHERE user_id = ? AND date = ? AND time >= ? AND meal_type = ?
-            ORDER BY id DESC LIMIT 1
-        ''', (user_id, now.strftime('%Y-%m-%d'), two_min_ago, meal_type))
-        
-        recent = cursor.fetchone()
-        if recent:
-            # Проверяем ТОЧНОЕ совпадение описания (игнорируя регистр)
-            recent_desc = recent['description'].lower().strip()
-            new_desc = description.lower().strip()
-            # Только если описания идентичны — это дубль
-            if recent_desc == new_desc:
-                conn.close()
-                return {
-                    "status": "duplicate_prevented",
-                    "message": f"Эта еда уже записана (ID {recent['id']}): {recent['description']}",
-                    "existing_meal_id": recent['id']
-                }
-        
-        cursor.execute('''
-            INSERT INTO meals (user_id, date, time, meal_type, description, calories, protein, fat, carbs, source)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id,
-            now.strftime('%Y-%m-%d'),
-            now.strftime('%H:%M'),
-            meal_type,
-            description,
-            round(calories, 1),
-            round(protein, 1),
-            round(fat, 1),
-            round(carbs, 1),
-            source
-        ))
-        
-        meal_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return {
-            "status": "success",
-            "message": f"Прием пищи сохранен с ID {meal_id}",
-            "meal_id": meal_id,
-            "saved_data": {
+        with _writer_connection() as conn:
+            ((meal_id, recent),) = _insert_meals(conn, user_id, [{
                 "description": description,
                 "calories": calories,
                 "protein": protein,
                 "fat": fat,
-                "carbs": carbs
+                "carbs": carbs,
+                "meal_type": meal_type,
+                "source": source
+            }])
+            
+            if recent is not None:
+                # Дубль — отдаём уже записанный приём
+                existing_id, existing_description = recent
+                return {
+                    "status": "duplicate_prevented",
+                    "message": f"Эта еда уже записана (ID {existing_id}): {existing_description}",
+                    "existing_meal_id": existing_id
+                }
+            
+            return {
+                "status": "success",
+                "message": f"Прием пищи сохранен с ID {meal_id}",
+                "meal_id": meal_id,
+                "saved_data": {
+                    "description": description,
+                    "calories": calories,
+                    "protein": protein,
+                    "fat": fat,
+                    "carbs": carbs
+                }
             }
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": f"Ошибка сохранения: {str(e)}"
         }
+
+
+def save_meals_bulk(user_id: str, meals: list[dict]) -> dict:
+    """
+    Сохраняет несколько приемов пищи одной транзакцией.
+    Используй вместо нескольких вызовов save_meal, когда пользователь
+    подтвердил запись сразу нескольких приемов пищи (например, завтрак и обед).
+    
+    Args:
+        user_id: Идентификатор пользователя
+        meals: Список словарей с полями description, calories, protein, fat, carbs
+               и необязательными meal_type (по умолчанию snack) и source (по умолчанию text)
+    
+    Returns:
+        dict: ID сохраненных записей и пропущенные дубли
+    """
+    try:
+        with _writer_connection() as conn:
+            results = _insert_meals(conn, user_id, meals)
+            
+            meal_ids = [meal_id for meal_id, _ in results if meal_id is not None]
+            duplicates = [
+                {"existing_meal_id": recent[0], "description": recent[1]}
+                for _, recent in results if recent is not None
+            ]
+            
+            return {
+                "status": "success",
+                "message": f"Сохранено приемов пищи: {len(meal_ids)}, пропущено дублей: {len(duplicates)}",
+                "meal_ids": meal_ids,
+                "duplicates": duplicates
+            }
     except Exception as e:
         return {
             "status": "error",
@@ -177,7 +684,7 @@ def get_today_meals(user_id: str) -> dict:
     Returns:
         dict: Список приемов пищи и суммарные показатели
     """
-    today = datetime.now().strftime('%Y-%m-%d')
+    today = _date.today().isoformat()
     return get_meals_by_date(user_id, today)
 
 
@@ -193,50 +700,74 @@ def get_meals_by_date(user_id: str, date: str) -> dict:
         dict: Список приемов пищи и статистика
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, time, meal_type, description, calories, protein, fat, carbs
-            FROM meals
-            WHERE user_id = ? AND date = ?
-            ORDER BY time
-        ''', (user_id, date))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        meals = []
-        totals = {"calories": 0, "protein": 0, "fat": 0, "carbs": 0}
-        
-        for row in rows:
-            meal = {
-                "id": row['id'],
-                "time": row['time'],
-                "meal_type": row['meal_type'],
-                "description": row['description'],
-                "calories": row['calories'] or 0,
-                "protein": row['protein'] or 0,
-                "fat": row['fat'] or 0,
-                "carbs": row['carbs'] or 0,
+        with _reader_connection() as conn:
+            # Строки уже в нужном виде (NULL -> 0 в запросе), итоги считает SQLite —
+            # по индексу idx_meals_user_date и сводке meal_daily_totals
+            meals = [dict(row) for row in conn.execute(SQL_SELECT_MEALS_BY_DATE, (user_id, date))]
+            totals = dict(conn.execute(SQL_SELECT_DAY_TOTALS, (user_id, date)).fetchone())
+            
+            return {
+                "status": "success",
+                "date": date,
+                "meals": meals,
+                "meals_count": len(meals),
+                "totals": totals
+            }
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": f"Ошибка получения данных: {str(e)}"
+        }
+
+
+def get_today_with_goals(user_id: str) -> dict:
+    """
+    Получает приемы пищи за сегодня вместе с целями пользователя.
+    
+    Итоги дня и цели читаются одним запросом на одном соединении —
+    вместо отдельных вызовов get_today_meals и get_user_goals.
+    
+    Args:
+        user_id: Идентификатор пользователя
+    
+    Returns:
+        dict: Список приемов пищи, суммарные показатели и цели
+    """
+    today = _date.today().isoformat()
+    try:
+        with _reader_connection() as conn:
+            meals = [dict(row) for row in conn.execute(SQL_SELECT_MEALS_BY_DATE, (user_id, today))]
+            row = conn.execute(
+                SQL_SELECT_DAY_TOTALS_WITH_GOALS, {"user_id": user_id, "date": today}
+            ).fetchone()
+        
+        if row['goal_type'] is None:
+            # Пользователя ещё нет — get_user_goals создаст его с целями по умолчанию
+            goals_result = get_user_goals(user_id)
+            if goals_result["status"] != "success":
+                return goals_result
+            goals = goals_result["goals"]
+        else:
+            goals = {
+                "goal_type": row['goal_type'],
+                "daily_calories": row['daily_calories'],
+                "daily_protein": row['daily_protein'],
+                "daily_fat": row['daily_fat'],
+                "daily_carbs": row['daily_carbs']
             }
-            meals.append(meal)
-            totals["calories"] += meal["calories"]
-            totals["protein"] += meal["protein"]
-            totals["fat"] += meal["fat"]
-            totals["carbs"] += meal["carbs"]
         
         return {
             "status": "success",
-            "date": date,
+            "date": today,
             "meals": meals,
             "meals_count": len(meals),
             "totals": {
-                "calories": round(totals["calories"], 1),
-                "protein": round(totals["protein"], 1),
-                "fat": round(totals["fat"], 1),
-                "carbs": round(totals["carbs"], 1)
-            }
+                "calories": row['calories'],
+                "protein": row['protein'],
+                "fat": row['fat'],
+                "carbs": row['carbs']
+            },
+            "goals": goals
         }
     except Exception as e:
         return {
@@ -256,58 +787,38 @@ def get_week_meals(user_id: str) -> dict:
         dict: Статистика по дням за неделю
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=7)
-        start_str = start_date.strftime('%Y-%m-%d')
-        end_str = end_date.strftime('%Y-%m-%d')
-        
-        cursor.execute('''
-            SELECT date, 
-                   SUM(calories) as calories,
-                   SUM(protein) as protein,
-                   SUM(fat) as fat,
-                   SUM(carbs) as carbs,
-                   COUNT(*) as meals_count
-            FROM meals
-            WHERE user_id = ? AND date BETWEEN ? AND ?
-            GROUP BY date
-            ORDER BY date
-        ''', (user_id, start_str, end_str))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        daily_stats = {}
-        for row in rows:
-            daily_stats[row['date']] = {
-                "calories": round(row['calories'] or 0, 1),
-                "protein": round(row['protein'] or 0, 1),
-                "fat": round(row['fat'] or 0, 1),
-                "carbs": round(row['carbs'] or 0, 1),
-                "meals_count": row['meals_count']
-            }
-        
-        # Средние значения
-        if daily_stats:
-            avg_calories = sum(d["calories"] for d in daily_stats.values()) / len(daily_stats)
-            avg_protein = sum(d["protein"] for d in daily_stats.values()) / len(daily_stats)
-        else:
-            avg_calories = 0
-            avg_protein = 0
-        
-        return {
-            "status": "success",
-            "period": f"{start_str} - {end_str}",
-            "days_with_data": len(daily_stats),
-            "daily_breakdown": daily_stats,
-            "averages": {
-                "calories": round(avg_calories, 1),
-                "protein": round(avg_protein, 1)
+        with _reader_connection() as conn:
+            end_date = _date.today()
+            start_str = (end_date - timedelta(days=7)).isoformat()
+            end_str = end_date.isoformat()
+            
+            # Простые кортежи вместо sqlite3.Row: поля разбираются по позиции
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(SQL_SELECT_WEEK_TOTALS, (user_id, start_str, end_str))
+            
+            daily_stats = {}
+            # Средние значения посчитаны в запросе — одинаковы в каждой строке
+            avg_calories = avg_protein = 0
+            for day, calories, protein, fat, carbs, meals_count, avg_calories, avg_protein in cursor:
+                daily_stats[day] = {
+                    "calories": calories,
+                    "protein": protein,
+                    "fat": fat,
+                    "carbs": carbs,
+                    "meals_count": meals_count
+                }
+            
+            return {
+                "status": "success",
+                "period": f"{start_str} - {end_str}",
+                "days_with_data": len(daily_stats),
+                "daily_breakdown": daily_stats,
+                "averages": {
+                    "calories": avg_calories,
+                    "protein": avg_protein
+                }
             }
-        }
     except Exception as e:
         return {
             "status": "error",
@@ -315,6 +826,13 @@ def get_week_meals(user_id: str) -> dict:
         }
 
 
+def _invalidate_goals_cache(user_id: str):
+    """Сбрасывает закэшированные цели пользователя после их изменения"""
+    with _goals_cache_lock:
+        _goals_generation[user_id] = _goals_generation.get(user_id, 0) + 1
+        _goals_cache.pop(user_id, None)
+
+
 def get_user_goals(user_id: str) -> dict:
     """
     Получает цели пользователя по питанию.
@@ -326,50 +844,43 @@ def get_user_goals(user_id: str) -> dict:
         dict: Цели пользователя (калории, БЖУ)
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        row = cursor.fetchone()
-        
-        if row:
-            conn.close()
-            return {
-                "status": "success",
-                "user_id": user_id,
-                "goals": {
-                    "goal_type": row['goal_type'],
-                    "daily_calories": row['daily_calories'],
-                    "daily_protein": row['daily_protein'],
-                    "daily_fat": row['daily_fat'],
-                    "daily_carbs": row['daily_carbs']
-                }
-            }
-        
-        # Создаем нового пользователя с дефолтными целями
-        default_goals = {
-            "goal_type": "maintenance",
-            "daily_calories": 2000,
-            "daily_protein": 150,
-            "daily_fat": 70,
-            "daily_carbs": 200
-        }
-        
-        cursor.execute('''
-            INSERT INTO users (user_id, goal_type, daily_calories, daily_protein, daily_fat, daily_carbs)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, default_goals["goal_type"], default_goals["daily_calories"],
-              default_goals["daily_protein"], default_goals["daily_fat"], default_goals["daily_carbs"]))
-        
-        conn.commit()
-        conn.close()
-        
-        return {
+        with _goals_cache_lock:
+            cached = _goals_cache.get(user_id)
+            generation = _goals_generation.get(user_id, 0)
+        if cached is not None:
+            return {"status": "success", "user_id": user_id, "goals": dict(cached)}
+        
+        with _reader_connection() as conn:
+            row = conn.execute(SQL_SELECT_USER, (user_id,)).fetchone()
+        created = False
+        
+        if row is None:
+            # Создаем нового пользователя с дефолтными целями — цели сразу из RETURNING
+            with _writer_connection() as conn:
+                with conn:
+                    row = conn.execute(SQL_INSERT_DEFAULT_USER, (user_id,)).fetchone()
+                created = row is not None
+                if not created:
+                    row = conn.execute(SQL_SELECT_USER, (user_id,)).fetchone()
+        
+        result = {
             "status": "success",
             "user_id": user_id,
-            "goals": default_goals,
-            "note": "Созданы цели по умолчанию"
+            "goals": {
+                "goal_type": row['goal_type'],
+                "daily_calories": row['daily_calories'],
+                "daily_protein": row['daily_protein'],
+                "daily_fat": row['daily_fat'],
+                "daily_carbs": row['daily_carbs']
+            }
         }
+        with _goals_cache_lock:
+            # Пока читали, update_user_goals мог сбросить кэш — тогда не кэшируем
+            if _goals_generation.get(user_id, 0) == generation:
+                _goals_cache[user_id] = dict(result["goals"])
+        if created:
+            result["note"] = "Созданы цели по умолчанию"
+        return result
     except Exception as e:
         return {
             "status": "error",
@@ -400,76 +911,72 @@ def update_user_goals(
         dict: Статус операции и обновленные цели
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        # Проверяем есть ли пользователь
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        row = cursor.fetchone()
-        
-        if not row:
-            # Создаем нового пользователя
-            cursor.execute('''
-                INSERT INTO users (user_id, goal_type, daily_calories, daily_protein, daily_fat, daily_carbs)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id,
-                goal_type or "maintenance",
-                daily_calories or 2000,
-                daily_protein or 150,
-                daily_fat or 70,
-                daily_carbs or 200
-            ))
-            conn.commit()
-            conn.close()
+        with _writer_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Проверяем есть ли пользователь
+            cursor.execute(SQL_SELECT_USER, (user_id,))
+            row = cursor.fetchone()
+            
+            if not row:
+                # Создаем нового пользователя
+                with conn:
+                    cursor.execute(SQL_INSERT_USER, (
+                        user_id,
+                        goal_type or "maintenance",
+                        daily_calories or 2000,
+                        daily_protein or 150,
+                        daily_fat or 70,
+                        daily_carbs or 200
+                    ))
+                _invalidate_goals_cache(user_id)
+                return {
+                    "status": "success",
+                    "message": "Создан новый пользователь с указанными целями"
+                }
+            
+            # Обновляем существующего пользователя
+            updates = []
+            params = []
+            
+            if goal_type:
+                updates.append("goal_type = ?")
+                params.append(goal_type)
+            if daily_calories:
+                updates.append("daily_calories = ?")
+                params.append(daily_calories)
+            if daily_protein:
+                updates.append("daily_protein = ?")
+                params.append(daily_protein)
+            if daily_fat:
+                updates.append("daily_fat = ?")
+                params.append(daily_fat)
+            if daily_carbs:
+                updates.append("daily_carbs = ?")
+                params.append(daily_carbs)
+            
+            if updates:
+                updates.append("updated_at = ?")
+                params.append(datetime.now().isoformat())
+                params.append(user_id)
+                
+                with conn:
+                    cursor.execute(f'''
+                        UPDATE users SET {", ".join(updates)} WHERE user_id = ?
+                    ''', params)
+                _invalidate_goals_cache(user_id)
+            
             return {
                 "status": "success",
-                "message": "Создан новый пользователь с указанными целями"
-            }
-        
-        # Обновляем существующего пользователя
-        updates = []
-        params = []
-        
-        if goal_type:
-            updates.append("goal_type = ?")
-            params.append(goal_type)
-        if daily_calories:
-            updates.append("daily_calories = ?")
-            params.append(daily_calories)
-        if daily_protein:
-            updates.append("daily_protein = ?")
-            params.append(daily_protein)
-        if daily_fat:
-            updates.append("daily_fat = ?")
-            params.append(daily_fat)
-        if daily_carbs:
-            updates.append("daily_carbs = ?")
-            params.append(daily_carbs)
-        
-        if updates:
-            updates.append("updated_at = ?")
-            params.append(datetime.now().isoformat())
-            params.append(user_id)
-            
-            cursor.execute(f'''
-                UPDATE users SET {", ".join(updates)} WHERE user_id = ?
-            ''', params)
-        
-        conn.commit()
-        conn.close()
-        
-        return {
-            "status": "success",
-            "message": "Цели обновлены",
-            "updated_goals": {
-                "goal_type": goal_type,
-                "daily_calories": daily_calories,
-                "daily_protein": daily_protein,
-                "daily_fat": daily_fat,
-                "daily_carbs": daily_carbs
+                "message": "Цели обновлены",
+                "updated_goals": {
+                    "goal_type": goal_type,
+                    "daily_calories": daily_calories,
+                    "daily_protein": daily_protein,
+                    "daily_fat": daily_fat,
+                    "daily_carbs": daily_carbs
+                }
             }
-        }
     except Exception as e:
         return {
             "status": "error",
@@ -502,72 +1009,46 @@ def edit_meal(
         dict: Статус операции
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        # Если ID не указан — берём последнюю запись пользователя
-        if meal_id is None:
-            cursor.execute('''
-                SELECT id FROM meals WHERE user_id = ? ORDER BY id DESC LIMIT 1
-            ''', (user_id,))
-            row = cursor.fetchone()
-            if not row:
-                conn.close()
-                return {"status": "error", "message": "Нет записей для редактирования"}
-            meal_id = row['id']
-        
-        # Проверяем что запись принадлежит пользователю
-        cursor.execute('SELECT * FROM meals WHERE id = ? AND user_id = ?', (meal_id, user_id))
-        meal = cursor.fetchone()
-        if not meal:
-            conn.close()
-            return {"status": "error", "message": f"Запись #{meal_id} не найдена"}
-        
-        # Собираем обновления
-        updates = []
-        params = []
+        # Собираем обновления: столбец -> новое значение
+        changes = {}
         
         if description is not None:
-            updates.append("description = ?")
-            params.append(description)
+            changes["description"] = description
         if calories is not None:
-            updates.append("calories = ?")
-            params.append(round(calories, 1))
+            changes["calories"] = calories
         if protein is not None:
-            updates.append("protein = ?")
-            params.append(round(protein, 1))
+            changes["protein"] = protein
         if fat is not None:
-            updates.append("fat = ?")
-            params.append(round(fat, 1))
+            changes["fat"] = fat
         if carbs is not None:
-            updates.append("carbs = ?")
-            params.append(round(carbs, 1))
+            changes["carbs"] = carbs
         
-        if not updates:
-            conn.close()
+        if not changes:
             return {"status": "error", "message": "Не указано что изменить"}
         
-        params.append(meal_id)
-        cursor.execute(f'UPDATE meals SET {", ".join(updates)} WHERE id = ?', params)
-        conn.commit()
-        
-        # Получаем обновленную запись
-        cursor.execute('SELECT * FROM meals WHERE id = ?', (meal_id,))
-        updated = cursor.fetchone()
-        conn.close()
+        set_clause = ", ".join(map(_MEAL_SET_EXPRESSIONS.__getitem__, changes))
+        # Если ID не указан — правим последнюю запись пользователя
+        if meal_id is None:
+            sql = SQL_UPDATE_LAST_MEAL.format(set_clause=set_clause)
+            params = (*changes.values(), user_id)
+        else:
+            sql = SQL_UPDATE_USER_MEAL.format(set_clause=set_clause)
+            params = (*changes.values(), meal_id, user_id)
         
-        return {
-            "status": "success",
-            "message": f"Запись #{meal_id} обновлена",
-            "updated_meal": {
-                "id": updated['id'],
-                "description": updated['description'],
-                "calories": updated['calories'],
-                "protein": updated['protein'],
-                "fat": updated['fat'],
-                "carbs": updated['carbs']
+        with _writer_connection() as conn:
+            with conn:
+                meal = conn.execute(sql, params).fetchone()
+            
+            if not meal:
+                if meal_id is None:
+                    return {"status": "error", "message": "Нет записей для редактирования"}
+                return {"status": "error", "message": f"Запись #{meal_id} не найдена"}
+            
+            return {
+                "status": "success",
+                "message": f"Запись #{meal['id']} обновлена",
+                "updated_meal": dict(meal)
             }
-        }
     except Exception as e:
         return {"status": "error", "message": f"Ошибка редактирования: {str(e)}"}
 
@@ -584,41 +1065,29 @@ def delete_meal(user_id: str, meal_id: Optional[int] = None) -> dict:
         dict: Статус операции
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        # Если ID не указан — берём последнюю запись
-        if meal_id is None:
-            cursor.execute('''
-                SELECT id, description FROM meals 
-                WHERE user_id = ? 
-                ORDER BY id DESC LIMIT 1
-            ''', (user_id,))
-        else:
-            cursor.execute('''
-                SELECT id, description FROM meals 
-                WHERE id = ? AND user_id = ?
-            ''', (meal_id, user_id))
-        
-        row = cursor.fetchone()
-        
-        if row:
-            found_id = row['id']
-            description = row['description']
+        with _writer_connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
             
-            cursor.execute('DELETE FROM meals WHERE id = ?', (found_id,))
-            conn.commit()
-            conn.close()
+            with conn:
+                # Если ID не указан — удаляем последнюю запись
+                if meal_id is None:
+                    cursor.execute(SQL_DELETE_LAST_MEAL, (user_id,))
+                else:
+                    cursor.execute(SQL_DELETE_USER_MEAL, (meal_id, user_id))
+                row = cursor.fetchone()
             
-            return {
-                "status": "success",
-                "message": f"Удалена запись #{found_id}: {description}"
-            }
-        else:
-            conn.close()
-            if meal_id:
-                return {"status": "error", "message": f"Запись #{meal_id} не найдена"}
-            return {"status": "error", "message": "Нет записей для удаления"}
+            if row:
+                found_id, description = row
+                
+                return {
+                    "status": "success",
+                    "message": f"Удалена запись #{found_id}: {description}"
+                }
+            else:
+                if meal_id:
+                    return {"status": "error", "message": f"Запись #{meal_id} не найдена"}
+                return {"status": "error", "message": "Нет записей для удаления"}
     except Exception as e:
         return {"status": "error", "message": f"Ошибка удаления: {str(e)}"}
 
@@ -650,81 +1119,142 @@ def save_weight(
         dict: Статус операции
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        now = datetime.now()
-        date_str = now.strftime('%Y-%m-%d')
-        time_str = now.strftime('%H:%M')
-        
-        # Проверяем есть ли уже запись за сегодня
-        cursor.execute('''
-            SELECT id, weight FROM weight_log WHERE user_id = ? AND date = ?
-        ''', (user_id, date_str))
-        existing = cursor.fetchone()
-        
-        if existing:
-            # Обновляем существующую запись
-            old_weight = existing['weight']
-            cursor.execute('''
-                UPDATE weight_log 
-                SET weight = ?, time = ?, note = ?, created_at = CURRENT_TIMESTAMP
-                WHERE user_id = ? AND date = ?
-            ''', (weight, time_str, note, user_id, date_str))
-            conn.commit()
-            conn.close()
-            
-            diff = weight - old_weight
-            diff_str = f"+{diff:.1f}" if diff > 0 else f"{diff:.1f}"
+        with _writer_connection() as conn:
+            cursor = conn.cursor()
+            # Строки разбираются по позиции — sqlite3.Row здесь не нужен
+            cursor.row_factory = None
             
-            return {
-                "status": "updated",
-                "message": f"Вес обновлён: {old_weight:.1f} → {weight:.1f} кг ({diff_str})",
-                "date": date_str,
+            params = {
+                "user_id": user_id,
                 "weight": weight,
-                "previous_weight": old_weight,
-                "change": round(diff, 2)
+                "note": note
             }
-        
-        # Создаем новую запись
-        cursor.execute('''
-            INSERT INTO weight_log (user_id, date, time, weight, note)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, date_str, time_str, weight, note))
-        
-        weight_id = cursor.lastrowid
-        conn.commit()
-        
-        # Получаем предыдущий вес для сравнения
-        cursor.execute('''
-            SELECT weight, date FROM weight_log 
-            WHERE user_id = ? AND date < ?
-            ORDER BY date DESC LIMIT 1
-        ''', (user_id, date_str))
-        prev = cursor.fetchone()
-        conn.close()
-        
-        if prev:
-            diff = weight - prev['weight']
-            diff_str = f"+{diff:.1f}" if diff > 0 else f"{diff:.1f}"
+            
+            # Сегодняшний и предыдущий вес, затем вставка или перезапись — одна транзакция.
+            # Транзакция открывается явно до SELECT: неявная началась бы только с UPSERT
+            with conn:
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute(SQL_SELECT_WEIGHT_CONTEXT, params)
+                date_str, time_str, old_weight, prev_weight, prev_date = cursor.fetchone()
+                params["date"], params["time"] = date_str, time_str
+                
+                cursor.execute(SQL_UPSERT_WEIGHT, params)
+                (weight_id,) = cursor.fetchone()
+            _invalidate_history_cache(user_id)
+            
+            if old_weight is not None:
+                # Запись за сегодня перезаписана
+                diff = weight - old_weight
+                
+                return {
+                    "status": "updated",
+                    "message": f"Вес обновлён: {old_weight:.1f} → {weight:.1f} кг ({diff:+.1f})",
+                    "date": date_str,
+                    "weight": weight,
+                    "previous_weight": old_weight,
+                    "change": round(diff, 2)
+                }
+            
+            if prev_weight is not None:
+                diff = weight - prev_weight
+                return {
+                    "status": "success",
+                    "message": f"Вес записан: {weight:.1f} кг ({diff:+.1f} с {prev_date})",
+                    "weight_id": weight_id,
+                    "date": date_str,
+                    "weight": weight,
+                    "previous_weight": prev_weight,
+                    "previous_date": prev_date,
+                    "change": round(diff, 2)
+                }
+            
             return {
                 "status": "success",
-                "message": f"Вес записан: {weight:.1f} кг ({diff_str} с {prev['date']})",
+                "message": f"Вес записан: {weight:.1f} кг (первая запись)",
                 "weight_id": weight_id,
                 "date": date_str,
-                "weight": weight,
-                "previous_weight": prev['weight'],
-                "previous_date": prev['date'],
-                "change": round(diff, 2)
+                "weight": weight
             }
-        
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": f"Ошибка сохранения веса: {str(e)}"
+        }
+
+
+def _invalidate_history_cache(user_id: str):
+    """Сбрасывает закэшированную историю веса пользователя после записи или удаления"""
+    with _history_cache_lock:
+        _history_generation[user_id] = _history_generation.get(user_id, 0) + 1
+        for key in [key for key in _history_cache if key[0] == user_id]:
+            _history_cache.pop(key, None)
+
+
+def save_weights_bulk(user_id: str, entries: list[dict]) -> dict:
+    """
+    Сохраняет несколько замеров веса за прошлые даты одной транзакцией
+    (пользователь перечисляет вес по дням или переносит записи из весов/приложений).
+    Замер за уже записанную дату перезаписывает её, как в save_weight.
+    Некорректные записи не сохраняются — по ним возвращаются ошибки.
+    
+    Args:
+        user_id: Идентификатор пользователя
+        entries: Список словарей с полями date (YYYY-MM-DD, не позже сегодня)
+                 и weight (кг, больше 0) и необязательными time (HH:MM,
+                 по умолчанию 00:00) и note
+    
+    Returns:
+        dict: Количество сохраненных замеров и ошибки по отклонённым записям
+    """
+    # Проверяем всё до транзакции: формат даты в старых базах не защищён CHECK,
+    # а кривая или будущая дата ломает выборки по периоду и поиск предыдущего веса
+    today = _date.today()
+    rows = []
+    errors = []
+    for index, entry in enumerate(entries):
+        try:
+            entry_date = _parse_date(entry["date"])
+            if entry_date > today:
+                raise ValueError(f"Дата в будущем: {entry_date.isoformat()}")
+            weight = entry["weight"]
+            if isinstance(weight, bool) or not isinstance(weight, (int, float)) or weight <= 0:
+                raise ValueError(f"Вес должен быть положительным числом: {weight!r}")
+            rows.append({
+                "user_id": user_id,
+                "date": entry_date.isoformat(),
+                "time": _check_time(entry.get("time", "00:00")),
+                "weight": float(weight),
+                "note": entry.get("note")
+            })
+        except KeyError as e:
+            errors.append({"index": index, "error": f"Не указано поле {e.args[0]}"})
+        except (TypeError, ValueError, AttributeError) as e:
+            errors.append({"index": index, "error": str(e)})
+
+    if not rows:
         return {
+            "status": "error",
+            "message": "Нет корректных замеров веса для сохранения",
+            "saved_count": 0,
+            "errors": errors
+        }
+
+    try:
+        with _writer_connection() as conn:
+            # with conn: один commit на всю пачку, rollback при ошибке
+            with conn:
+                conn.executemany(SQL_UPSERT_WEIGHT_ROWS, rows)
+        _invalidate_history_cache(user_id)
+        
+        result = {
             "status": "success",
-            "message": f"Вес записан: {weight:.1f} кг (первая запись)",
-            "weight_id": weight_id,
-            "date": date_str,
-            "weight": weight
+            "message": f"Сохранено замеров веса: {len(rows)}",
+            "saved_count": len(rows)
         }
+        if errors:
+            result["message"] += f", отклонено: {len(errors)}"
+            result["errors"] = errors
+        return result
     except Exception as e:
         return {
             "status": "error",
@@ -744,65 +1274,47 @@ def get_weight_history(user_id: str, days: int = 30) -> dict:
         dict: История веса со статистикой
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=days)
-        start_str = start_date.strftime('%Y-%m-%d')
-        end_str = end_date.strftime('%Y-%m-%d')
-        
-        cursor.execute('''
-            SELECT date, time, weight, note
-            FROM weight_log
-            WHERE user_id = ? AND date BETWEEN ? AND ?
-            ORDER BY date DESC
-        ''', (user_id, start_str, end_str))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        if not rows:
-            return {
+        # Период — по календарным датам: date.today() без времени и срезов
+        end_date = _date.today()
+        start_str = (end_date - timedelta(days=days)).isoformat()
+        end_str = end_date.isoformat()
+        
+        # Дата в ключе — с наступлением нового дня период сдвигается
+        key = (user_id, days, end_str)
+        with _history_cache_lock:
+            cached = _history_cache.get(key)
+            generation = _history_generation.get(user_id, 0)
+        if cached is not None:
+            # Каждому вызову — своя копия: изменения не попадут в кэш
+            return copy.deepcopy(cached)
+        
+        params = {"user_id": user_id, "start": start_str, "end": end_str}
+        with _reader_connection() as conn:
+            entries = [dict(row) for row in conn.execute(SQL_SELECT_WEIGHT_HISTORY, params)]
+            if entries:
+                stats = dict(conn.execute(SQL_SELECT_WEIGHT_STATS, params).fetchone())
+        
+        if not entries:
+            result = {
                 "status": "success",
                 "message": "Записей о весе не найдено",
                 "entries": [],
                 "count": 0
             }
-        
-        entries = []
-        weights = []
-        for row in rows:
-            entries.append({
-                "date": row['date'],
-                "time": row['time'],
-                "weight": row['weight'],
-                "note": row['note']
-            })
-            weights.append(row['weight'])
-        
-        # Статистика
-        current = weights[0]  # последний замер (сортировка DESC)
-        first = weights[-1]   # первый замер в периоде
-        total_change = current - first
-        min_weight = min(weights)
-        max_weight = max(weights)
-        avg_weight = sum(weights) / len(weights)
-        
-        return {
-            "status": "success",
-            "period": f"{start_str} — {end_str}",
-            "entries": entries,
-            "count": len(entries),
-            "stats": {
-                "current_weight": round(current, 1),
-                "start_weight": round(first, 1),
-                "total_change": round(total_change, 2),
-                "min_weight": round(min_weight, 1),
-                "max_weight": round(max_weight, 1),
-                "avg_weight": round(avg_weight, 1)
+        else:
+            result = {
+                "status": "success",
+                "period": f"{start_str} — {end_str}",
+                "entries": entries,
+                "count": len(entries),
+                "stats": stats
             }
-        }
+        
+        with _history_cache_lock:
+            # Пока читали, save_weight/delete мог сбросить кэш — тогда не кэшируем
+            if _history_generation.get(user_id, 0) == generation:
+                _history_cache[key] = result
+        return copy.deepcopy(result)
     except Exception as e:
         return {
             "status": "error",
@@ -810,7 +1322,24 @@ def get_weight_history(user_id: str, days: int = 30) -> dict:
         }
 
 
-def get_weight_nutrition_analysis(user_id: str, days: int = 14) -> dict:
+# Сводка анализа, когда за период нет данных (ключи те же, что в полном ответе)
+_EMPTY_ANALYSIS_SUMMARY = {
+    "weight_entries": 0,
+    "nutrition_entries": 0,
+    "weight_change": None,
+    "start_weight": None,
+    "current_weight": None,
+    "avg_daily_calories": None,
+    "avg_daily_deficit": None,
+    "expected_weight_change": None
+}
+
+
+def get_weight_nutrition_analysis(
+    user_id: str,
+    days: int = 14,
+    include_insight: bool = True
+) -> dict:
     """
     Анализирует связь между весом и питанием.
     Показывает динамику веса вместе с данными о потреблении калорий.
@@ -818,113 +1347,103 @@ def get_weight_nutrition_analysis(user_id: str, days: int = 14) -> dict:
     Args:
         user_id: Идентификатор пользователя
         days: Период анализа в днях (по умолчанию 14)
+        include_insight: Добавить текстовый вывод (insight); False — только цифры
     
     Returns:
         dict: Комбинированный анализ веса и питания
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=days)
-        start_str = start_date.strftime('%Y-%m-%d')
-        end_str = end_date.strftime('%Y-%m-%d')
-        
-        # Получаем вес
-        cursor.execute('''
-            SELECT date, weight FROM weight_log
-            WHERE user_id = ? AND date BETWEEN ? AND ?
-            ORDER BY date
-        ''', (user_id, start_str, end_str))
-        weight_rows = cursor.fetchall()
-        
-        # Получаем питание (агрегированное по дням)
-        cursor.execute('''
-            SELECT date, 
-                   SUM(calories) as calories,
-                   SUM(protein) as protein,
-                   SUM(fat) as fat,
-                   SUM(carbs) as carbs
-            FROM meals
-            WHERE user_id = ? AND date BETWEEN ? AND ?
-            GROUP BY date
-            ORDER BY date
-        ''', (user_id, start_str, end_str))
-        nutrition_rows = cursor.fetchall()
-        
-        # Получаем цели пользователя
-        cursor.execute('SELECT daily_calories FROM users WHERE user_id = ?', (user_id,))
-        user_row = cursor.fetchone()
-        daily_goal = user_row['daily_calories'] if user_row else 2000
-        
-        conn.close()
-        
-        # Собираем данные по дням
-        weight_data = {row['date']: row['weight'] for row in weight_rows}
-        nutrition_data = {row['date']: {
-            'calories': row['calories'] or 0,
-            'protein': row['protein'] or 0,
-            'fat': row['fat'] or 0,
-            'carbs': row['carbs'] or 0
-        } for row in nutrition_rows}
-        
-        # Комбинируем данные
-        combined = []
-        all_dates = sorted(set(weight_data.keys()) | set(nutrition_data.keys()))
-        
-        for date in all_dates:
-            entry = {"date": date}
-            if date in weight_data:
-                entry["weight"] = weight_data[date]
-            if date in nutrition_data:
-                entry["calories"] = round(nutrition_data[date]['calories'], 0)
-                entry["protein"] = round(nutrition_data[date]['protein'], 1)
-                entry["deficit_surplus"] = round(daily_goal - nutrition_data[date]['calories'], 0)
-            combined.append(entry)
-        
-        # Аналитика
-        if len(weight_data) >= 2:
-            weights = list(weight_data.values())
-            first_weight = weights[0]
-            last_weight = weights[-1]
-            weight_change = last_weight - first_weight
-        else:
-            weight_change = None
-            first_weight = None
-            last_weight = None
-        
-        if nutrition_data:
-            calories_list = [d['calories'] for d in nutrition_data.values()]
-            avg_calories = sum(calories_list) / len(calories_list)
-            avg_deficit = daily_goal - avg_calories
-        else:
-            avg_calories = None
-            avg_deficit = None
-        
-        # Рассчёт: при дефиците ~7700 ккал теряется ~1 кг
-        expected_change = None
-        if avg_deficit is not None and len(nutrition_data) > 0:
-            total_deficit = avg_deficit * len(nutrition_data)
-            expected_change = round(-total_deficit / 7700, 2)  # минус = потеря веса
-        
-        return {
-            "status": "success",
-            "period": f"{start_str} — {end_str}",
-            "daily_goal": daily_goal,
-            "daily_data": combined,
-            "summary": {
-                "weight_entries": len(weight_data),
-                "nutrition_entries": len(nutrition_data),
-                "weight_change": round(weight_change, 2) if weight_change is not None else None,
-                "start_weight": round(first_weight, 1) if first_weight else None,
-                "current_weight": round(last_weight, 1) if last_weight else None,
-                "avg_daily_calories": round(avg_calories, 0) if avg_calories else None,
-                "avg_daily_deficit": round(avg_deficit, 0) if avg_deficit else None,
-                "expected_weight_change": expected_change
-            },
-            "insight": _generate_weight_insight(weight_change, expected_change, avg_deficit)
-        }
+        with _reader_connection() as conn:
+            cursor = conn.cursor()
+            # Строки разбираются по позиции — sqlite3.Row здесь не нужен
+            cursor.row_factory = None
+            
+            # Период — по календарным датам: date.today() без времени и срезов
+            end_date = _date.today()
+            start_str = (end_date - timedelta(days=days)).isoformat()
+            end_str = end_date.isoformat()
+            
+            cursor.execute(SQL_SELECT_WEIGHT_NUTRITION, {
+                "user_id": user_id,
+                "start": start_str,
+                "end": end_str
+            })
+            rows = cursor.fetchall()
+            daily_goal = rows[0][6]
+            
+            if rows[0][0] is None:
+                # За период нет ни веса, ни питания — анализировать нечего
+                result = {
+                    "status": "success",
+                    "period": f"{start_str} — {end_str}",
+                    "daily_goal": daily_goal,
+                    "daily_data": [],
+                    "summary": dict(_EMPTY_ANALYSIS_SUMMARY)
+                }
+                if include_insight:
+                    result["insight"] = _generate_weight_insight(None, None, None)
+                return result
+            
+            # Один проход по дням: ответ по дням и накопители для аналитики
+            combined = []
+            weights = []
+            calories_total = 0
+            nutrition_entries = 0
+            for date, weight, calories, calories_rounded, protein, deficit_surplus, _ in rows:
+                entry = {"date": date}
+                if weight is not None:
+                    entry["weight"] = weight
+                    weights.append(weight)
+                if calories is not None:
+                    entry["calories"] = calories_rounded
+                    entry["protein"] = protein
+                    entry["deficit_surplus"] = deficit_surplus
+                    calories_total += calories
+                    nutrition_entries += 1
+                combined.append(entry)
+            
+            # Аналитика
+            if len(weights) >= 2:
+                first_weight = weights[0]
+                last_weight = weights[-1]
+                weight_change = last_weight - first_weight
+            else:
+                weight_change = None
+                first_weight = None
+                last_weight = None
+            
+            if nutrition_entries:
+                avg_calories = calories_total / nutrition_entries
+                avg_deficit = daily_goal - avg_calories
+            else:
+                avg_calories = None
+                avg_deficit = None
+            
+            # Рассчёт: при дефиците ~7700 ккал теряется ~1 кг
+            expected_change = None
+            if avg_deficit is not None:
+                total_deficit = avg_deficit * nutrition_entries
+                expected_change = round(-total_deficit / 7700, 2)  # минус = потеря веса
+            
+            result = {
+                "status": "success",
+                "period": f"{start_str} — {end_str}",
+                "daily_goal": daily_goal,
+                "daily_data": combined,
+                "summary": {
+                    "weight_entries": len(weights),
+                    "nutrition_entries": nutrition_entries,
+                    "weight_change": round(weight_change, 2) if weight_change is not None else None,
+                    "start_weight": round(first_weight, 1) if first_weight else None,
+                    "current_weight": round(last_weight, 1) if last_weight else None,
+                    "avg_daily_calories": round(avg_calories, 0) if avg_calories else None,
+                    "avg_daily_deficit": round(avg_deficit, 0) if avg_deficit else None,
+                    "expected_weight_change": expected_change
+                }
+            }
+            if include_insight:
+                result["insight"] = _generate_weight_insight(weight_change, expected_change, avg_deficit)
+            return result
     except Exception as e:
         return {
             "status": "error",
@@ -932,36 +1451,44 @@ def get_weight_nutrition_analysis(user_id: str, days: int = 14) -> dict:
         }
 
 
+# Инсайты анализа веса: ключ — (знак дефицита калорий, темп изменения веса).
+# Дефицит: 1, профицит: -1. Темп — "on_track" (в пределах 0.5 кг от ожидаемого),
+# "faster"/"slower" относительно ожидаемого, None — вес меняется не в ту сторону
+_WEIGHT_INSIGHTS = {
+    (1, "on_track"): "✅ Отлично! Вес снижается в соответствии с дефицитом калорий.",
+    (1, "faster"): "🎯 Вес снижается быстрее ожидаемого. Возможно, есть незамеченные источники активности или воды.",
+    (1, "slower"): "📊 Вес снижается медленнее ожидаемого. Проверь точность записей еды.",
+    (1, None): "⚠️ При дефиците калорий вес растёт. Возможны: задержка воды, неточный учёт еды, или период адаптации.",
+    (-1, "on_track"): "💪 Вес набирается в соответствии с профицитом калорий.",
+    (-1, "faster"): "📊 Набор веса отличается от ожидаемого. Нормально при колебаниях воды.",
+    (-1, "slower"): "📊 Набор веса отличается от ожидаемого. Нормально при колебаниях воды.",
+    (-1, None): "🔥 Несмотря на профицит, вес не растёт. Возможно, высокий уровень активности.",
+}
+_INSIGHT_NO_DATA = "Недостаточно данных для анализа. Продолжай записывать вес и питание!"
+_INSIGHT_MAINTENANCE = "⚖️ Калории примерно соответствуют поддержанию веса."
+
+
 def _generate_weight_insight(weight_change, expected_change, avg_deficit):
     """Генерирует инсайт на основе данных о весе и питании."""
     if weight_change is None or expected_change is None:
-        return "Недостаточно данных для анализа. Продолжай записывать вес и питание!"
+        return _INSIGHT_NO_DATA
     
-    # Сравниваем фактическое изменение веса с ожидаемым
-    diff = weight_change - expected_change
-    
-    if avg_deficit > 0:  # Дефицит калорий
-        if weight_change < 0:
-            if abs(diff) < 0.5:
-                return "✅ Отлично! Вес снижается в соответствии с дефицитом калорий."
-            elif weight_change < expected_change:
-                return "🎯 Вес снижается быстрее ожидаемого. Возможно, есть незамеченные источники активности или воды."
-            else:
-                return "📊 Вес снижается медленнее ожидаемого. Проверь точность записей еды."
-        else:
-            return "⚠️ При дефиците калорий вес растёт. Возможны: задержка воды, неточный учёт еды, или период адаптации."
+    deficit_sign = (avg_deficit > 0) - (avg_deficit < 0)
+    if not deficit_sign:
+        return _INSIGHT_MAINTENANCE
     
-    elif avg_deficit < 0:  # Профицит калорий
-        if weight_change > 0:
-            if abs(diff) < 0.5:
-                return "💪 Вес набирается в соответствии с профицитом калорий."
-            else:
-                return "📊 Набор веса отличается от ожидаемого. Нормально при колебаниях воды."
-        else:
-            return "🔥 Несмотря на профицит, вес не растёт. Возможно, высокий уровень активности."
+    # При дефиците вес должен снижаться, при профиците — расти
+    if weight_change * deficit_sign >= 0:
+        return _WEIGHT_INSIGHTS[(deficit_sign, None)]
     
+    # Сравниваем фактическое изменение веса с ожидаемым
+    if abs(weight_change - expected_change) < 0.5:
+        pace = "on_track"
+    elif weight_change < expected_change:
+        pace = "faster"
     else:
-        return "⚖️ Калории примерно соответствуют поддержанию веса."
+        pace = "slower"
+    return _WEIGHT_INSIGHTS[(deficit_sign, pace)]
 
 
 def delete_weight(user_id: str, date: Optional[str] = None) -> dict:
@@ -976,37 +1503,29 @@ def delete_weight(user_id: str, date: Optional[str] = None) -> dict:
         dict: Статус операции
     """
     try:
-        conn = _get_connection()
-        cursor = conn.cursor()
-        
-        if date:
-            cursor.execute('''
-                SELECT id, date, weight FROM weight_log 
-                WHERE user_id = ? AND date = ?
-            ''', (user_id, date))
-        else:
-            cursor.execute('''
-                SELECT id, date, weight FROM weight_log 
-                WHERE user_id = ? 
-                ORDER BY date DESC LIMIT 1
-            ''', (user_id,))
-        
-        row = cursor.fetchone()
-        
-        if row:
-            cursor.execute('DELETE FROM weight_log WHERE id = ?', (row['id'],))
-            conn.commit()
-            conn.close()
-            return {
-                "status": "success",
-                "message": f"Удалена запись о весе за {row['date']}: {row['weight']} кг"
-            }
-        else:
-            conn.close()
-            return {
-                "status": "error",
-                "message": "Запись о весе не найдена"
-            }
+        with _writer_connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            
+            with conn:
+                if date:
+                    cursor.execute(SQL_DELETE_WEIGHT_BY_DATE, (user_id, date))
+                else:
+                    cursor.execute(SQL_DELETE_LAST_WEIGHT, (user_id,))
+                row = cursor.fetchone()
+            
+            if row:
+                _invalidate_history_cache(user_id)
+                deleted_date, deleted_weight = row
+                return {
+                    "status": "success",
+                    "message": f"Удалена запись о весе за {deleted_date}: {deleted_weight} кг"
+                }
+            else:
+                return {
+                    "status": "error",
+                    "message": "Запись о весе не найдена"
+                }
     except Exception as e:
         return {
             "status": "error",
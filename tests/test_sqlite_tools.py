@@ -0,0 +1,51 @@
+"""Тесты save_weights_bulk: проверка записей до транзакции"""
+import queue
+from datetime import date, timedelta
+
+import pytest
+
+from nutrition_tracker.tools import sqlite_tools
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Отдельная база во временной папке вместо nutrition.db"""
+    monkeypatch.setattr(sqlite_tools, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(sqlite_tools, "_writer", None)
+    monkeypatch.setattr(sqlite_tools, "_readers", queue.LifoQueue(maxsize=sqlite_tools.READER_POOL_SIZE))
+    monkeypatch.setattr(sqlite_tools, "_readers_opened", 0)
+    sqlite_tools._history_cache.clear()
+    sqlite_tools._init_db()
+    yield
+    if sqlite_tools._writer is not None:
+        sqlite_tools._writer.close()
+
+
+def test_save_weights_bulk_rejects_invalid_entries(db):
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    result = sqlite_tools.save_weights_bulk("u1", [
+        {"date": yesterday, "weight": 80.5},
+        {"date": "2026/10/01", "weight": 80},
+        {"date": yesterday, "time": "9:05", "weight": 80},
+        {"date": yesterday},
+    ])
+
+    assert result["status"] == "success"
+    assert result["saved_count"] == 1
+    assert [error["index"] for error in result["errors"]] == [1, 2, 3]
+    assert "weight" in result["errors"][2]["error"]
+
+    history = sqlite_tools.get_weight_history("u1", days=7)
+    assert [entry["date"] for entry in history["entries"]] == [yesterday]
+
+
+def test_save_weights_bulk_rejects_future_date_and_bad_weight(db):
+    tomorrow = (date.today() + timedelta(days=1)).isoformat()
+    result = sqlite_tools.save_weights_bulk("u1", [
+        {"date": tomorrow, "weight": 80},
+        {"date": date.today().isoformat(), "weight": -1},
+    ])
+
+    assert result["status"] == "error"
+    assert result["saved_count"] == 0
+    assert len(result["errors"]) == 2